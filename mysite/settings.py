@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'polls.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,9 +55,32 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'mysite.urls'
 
+# ModelBackend is kept so the sessions opened before SurveyUserBackend still work
+AUTHENTICATION_BACKENDS = [
+    'polls.auth.SurveyUserBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+# Sessions are kept in the database, so a logout reaches every process at once.
+# Set POLLS_SESSION_CACHE to the alias of a cache shared by all the processes to
+# read them from that cache instead, with the cached_db engine, e.g.
+#   CACHES = {
+#       'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+#       'sessions': {'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#                    'LOCATION': '127.0.0.1:11211'},
+#   }
+#   POLLS_SESSION_CACHE = 'sessions'
+# The engine keeps each session in the cache for as long as the session lasts
+# (two weeks by default), whatever the TIMEOUT of the cache, so the polls.E001
+# check rejects caches private to each process, like the local memory one.
+POLLS_SESSION_CACHE = None
+if POLLS_SESSION_CACHE:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    SESSION_CACHE_ALIAS = POLLS_SESSION_CACHE
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'polls.instrumentation.TimedDjangoTemplates',
         'DIRS': [str(BASE_DIR.joinpath('templates'))],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,9 +105,34 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Matching and the exports read the answers of everyone from this DATABASES alias
+# instead of 'default', so they don't compete with the votes. It can be a streaming
+# replica or a copy of the SQLite file refreshed with `manage.py snapshotdb`, e.g.
+#   DATABASES['replica'] = {'ENGINE': 'django.db.backends.sqlite3',
+#                           'NAME': BASE_DIR / 'replica.sqlite3', 'CONN_MAX_AGE': 60}
+#   POLLS_READ_DATABASE = 'replica'
+# The answers of the user being matched are always read from 'default'.
+POLLS_READ_DATABASE = None
+DATABASE_ROUTERS = ['polls.routers.ReadReplicaRouter']
+
+# Set by polls.database on every new SQLite connection. WAL lets reads run while a
+# vote is being written and, with synchronous=normal, makes commits much cheaper.
+# Compare against SQLite defaults with `manage.py benchmarkpolls --scenarios contention`.
+POLLS_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative is in KiB
+    'busy_timeout': 5000,  # milliseconds
+}
+
+# Times a vote or profile change is retried when the database is locked
+POLLS_WRITE_RETRIES = 3
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -120,9 +169,73 @@ MEDIA_URL = '/media/'
 
 STATIC_URL = '/static/'
 
+# `manage.py collectstatic` copies the static files here with content hashed names
+# plus gzip (and brotli, with the brotli package installed) variants. With DEBUG off
+# they are served by polls.staticfiles.serve with far-future immutable cache headers,
+# and collectstatic must run on every deploy.
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+STATICFILES_STORAGE = 'polls.staticfiles.PrecompressedManifestStaticFilesStorage'
+
+# Uploaded choice and configuration images are also saved as WebP in these widths,
+# under MEDIA_ROOT/renditions with content hashed names. `manage.py makerenditions`
+# makes them for images uploaded before.
+POLLS_IMAGE_WIDTHS = [320, 640, 1280]
+POLLS_IMAGE_QUALITY = 80
+
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/' # new
 
+# Run the match recompute jobs right away in the request that queues them,
+# instead of in a separate `manage.py runmatchworker` process.
+POLLS_MATCH_JOBS_INLINE = False
+
+# Serve the index, question, vote and profile pages with the async views of
+# polls.async_views. Only worth it when running under an ASGI server (mysite.asgi),
+# under WSGI they are run in an event loop of their own on every request.
+POLLS_ASYNC_VIEWS = False
+
+# 'exact' scores every candidate. 'approximate' with POLLS_LSH_BANDS > 0 rebuilds
+# the match list of a user only from the candidates that answered at least one band
+# of POLLS_LSH_BAND_SIZE random questions exactly like it, looked up in the LshBucket
+# index. Run `manage.py indexlsh` after turning it on or changing the bands, and
+# compare recall and latency with `manage.py matchingreport`. Without bands, it's exact.
+POLLS_MATCHING_MODE = 'exact'
+POLLS_LSH_BANDS = 0
+POLLS_LSH_BAND_SIZE = 4
+
+# Path prefix of a file that keeps the answers of every user that completed the
+# poll, mapped into memory and shared by all the processes of the site (best on
+# a tmpfs like /dev/shm, Unix only), or None to read them from the database on
+# every match recompute. With it, POLLS_MATCHING_PROCESSES > 1 scores the
+# candidates of matrices of at least POLLS_PARALLEL_MIN_ROWS users in a pool of
+# that many processes.
+POLLS_SHARED_MATRIX = None
+POLLS_MATCHING_PROCESSES = 0
+POLLS_PARALLEL_MIN_ROWS = 50000
+
+# AppConfig.get() keeps its own copy for POLLS_CONFIG_TIMEOUT seconds. The
+# question catalogue is kept until it changes, which every process checks on
+# each use with one primary key lookup of CatalogueGeneration. With a cache
+# alias in POLLS_CONFIG_CACHE, processes share both through that cache instead,
+# so config changes reach everyone as soon as their copy expires, and question
+# changes are checked in the cache without the query.
+POLLS_CONFIG_CACHE = None
+POLLS_CONFIG_TIMEOUT = 60
+
+# Release identifier (a commit hash, a version number) mixed into the ETag of the
+# question pages, so browsers don't keep a page rendered by an older release. If
+# None, a hash of the page templates and of the static files manifest is used.
+POLLS_DEPLOY_VERSION = None
+
+# The rendered match list of the last POLLS_FRAGMENT_CACHE_SIZE users that
+# visited the index is kept in each process, for POLLS_FRAGMENT_TIMEOUT seconds
+# at most. It's rendered again as soon as the list changes.
+POLLS_FRAGMENT_CACHE_SIZE = 1000
+POLLS_FRAGMENT_TIMEOUT = 60
+
+# Seconds between writes of the request timing histograms to the database
+POLLS_METRICS_FLUSH_INTERVAL = 30
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -14,10 +14,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from polls import staticfiles
+
 urlpatterns = [
     path('', include('polls.urls')),
     path('accounts/', include('django.contrib.auth.urls')),
@@ -27,3 +29,7 @@ urlpatterns = [
 
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+else:
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), staticfiles.serve),
+    ]
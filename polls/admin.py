@@ -1,8 +1,52 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count
+from django.utils.functional import cached_property
 from .models import *
+from .catalogue import get_catalogue
+from .jobs import enqueue_match_update
+from .matching import lsh_bands, rebuild_lsh_index
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 
 
+def estimated_count(model, using):
+    """Approximate row count of the table of model, from the table statistics on
+    PostgreSQL and MySQL or the highest id elsewhere. None if there is no estimate."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+        else:
+            qn = connection.ops.quote_name
+            cursor.execute("SELECT MAX(%s) FROM %s" % (qn(model._meta.pk.column), qn(table)))
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:  # never analyzed
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator for the changelists of big tables: when nothing is filtered, the page
+    count comes from estimated_count() instead of a COUNT(*) over the whole table"""
+
+    # below this many rows the count is exact
+    ESTIMATE_MIN_ROWS = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.ESTIMATE_MIN_ROWS:
+                return estimate
+        return super().count
+
+
 class ChoiceInline(admin.StackedInline):
     model = Choice
     extra = 0
@@ -14,6 +58,86 @@ class QuestionAdmin(admin.ModelAdmin):
         ('Date information', {'fields': ['pub_date'], 'classes': ['collapse']}),
     ]
     inlines = [ChoiceInline]
+    search_fields = ['question_text']  # for the answer autocomplete
+    ordering = ['id']
+
+    # answer vectors are keyed by question position, so adding or removing
+    # questions shifts them and requires a rebuild, and so do the LSH keys.
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change:
+            rebuild_answers()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        rebuild_answers()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        rebuild_answers()
+
+
+def rebuild_answers():
+    questions = get_catalogue().questions
+    AnswerVector.refresh_all(questions)
+    if lsh_bands():
+        rebuild_lsh_index(questions)
+
+
+def refresh_answers(users):
+    """Rebuilds the answer vector of the given users after an admin edit and queues their matches"""
+    questions = get_catalogue().questions
+    for user in users:
+        AnswerVector.refresh(user, questions)
+        enqueue_match_update(user)
+
+
+# Keeps the answer vector, matches and result counters of the user in sync with the edited answers.
+# There are many answers per user: lists and searches only use indexed columns, and pick
+# users by id instead of listing every one of them.
+class AnswerAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'question', 'choice')
+    list_select_related = ('user', 'question')
+    list_filter = ('question',)
+    search_fields = ('user__username__exact',)
+    raw_id_fields = ('user',)
+    autocomplete_fields = ('question',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        deltas = {(obj.question_id, obj.choice): 1}
+        if change:
+            previous = (form.initial['question'], form.initial['choice'])
+            deltas[previous] = deltas.get(previous, 0) - 1
+        ChoiceCount.add(deltas)
+
+        users = [obj.user]
+        if change and 'user' in form.changed_data:  # moved away from the previous user
+            users.append(User.objects.get(pk=form.initial['user']))
+        refresh_answers(users)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        ChoiceCount.add({(obj.question_id, obj.choice): -1})
+        refresh_answers([obj.user])
+
+    def delete_queryset(self, request, queryset):
+        users = list(User.objects.filter(answer__in=queryset).distinct())
+        counts = queryset.values('question_id', 'choice').annotate(votes=Count('id')).order_by()
+        deltas = {(c['question_id'], c['choice']): -c['votes'] for c in counts}
+        super().delete_queryset(request, queryset)
+        ChoiceCount.add(deltas)
+        refresh_answers(users)
+
+
+# Match lists depend on how many candidates are shown and on the gender filter
+class AppConfigAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change or {'afinidad_cantidad_gente', 'pedir_genero'} & set(form.changed_data):
+            AnswerVector.objects.update(matches_stale=True)
 
 
 # Define an inline admin descriptor for Profile model
@@ -27,11 +151,22 @@ class ProfileInline(admin.StackedInline):
 # Define a new User admin
 class UserAdmin(BaseUserAdmin):
     inlines = (ProfileInline,)
+    list_filter = BaseUserAdmin.list_filter + ('profile__gender', 'profile__gender_preference')
+    # whole usernames, which the unique index on username finds, unlike the LIKE of
+    # icontains or startswith that scans the table. Emails have no index to search.
+    search_fields = ('username__exact',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        if change:  # the profile may have changed who is a candidate for this user
+            enqueue_match_update(form.instance)
 
 
 # Re-register UserAdmin
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(Question, QuestionAdmin)
-admin.site.register(Answer)
-admin.site.register(AppConfig)
+admin.site.register(Answer, AnswerAdmin)
+admin.site.register(AppConfig, AppConfigAdmin)
@@ -0,0 +1,31 @@
+"""Bit sampling LSH for the 'approximate' matching mode. Every band looks at the
+answers to a few random questions, and two users share the key of a band when they
+answered those questions the same way. The keys of every user that completed the
+poll are stored in LshBucket, so the candidates of a user are found with an indexed
+lookup of its own keys instead of scanning everyone."""
+import hashlib
+
+import numpy as np
+
+
+def band_columns(question_count, bands, band_size, seed=0):
+    """Question positions looked at by every band, drawn from a fixed seed so they are
+    the same in every process"""
+    rng = np.random.default_rng(seed)
+    return [rng.choice(question_count, size=min(band_size, question_count), replace=False) for _ in range(bands)]
+
+
+def band_keys(choices, question_ids, bands, band_size, seed=0):
+    """LSH keys of every row of a users x questions choice matrix, as a users x bands
+    int64 array. The keys also depend on the ids of the questions of each band, so they
+    all change when the questions do."""
+    keys = np.zeros((len(choices), bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for band, cols in enumerate(band_columns(choices.shape[1], bands, band_size, seed)):
+            salt = '%d|%d|%s' % (seed, band, ','.join(str(question_ids[c]) for c in cols))
+            key = np.full(len(choices), int.from_bytes(hashlib.sha1(salt.encode()).digest()[:8], 'little'),
+                          dtype=np.uint64)
+            for c in cols:
+                key = key * np.uint64(1000003) ^ (choices[:, c] + 2).astype(np.uint64)
+            keys[:, band] = key
+    return keys.view(np.int64)
@@ -0,0 +1,97 @@
+"""Async versions of the survey views, used instead of the ones in polls.views when
+POLLS_ASYNC_VIEWS is set and the site is served through mysite.asgi.
+
+Django 3.1 has no async ORM, so every step that reads or writes the database,
+matching included, runs through sync_to_async while the request itself waits on
+the event loop without holding a thread. Saving answers and profiles runs in
+Django's single thread for sync code, so writes stay serialized; the steps that
+only read, and rendering, run in the thread pool so concurrent page views don't
+queue behind each other. Django only closes the connections of the thread that
+handles the request signals, so those steps close their own when they end."""
+import functools
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.http import HttpResponseBadRequest, HttpResponseRedirect
+from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+
+from . import views
+
+def _read(fn):
+    """sync_to_async for a step that only reads, run in the thread pool"""
+    @functools.wraps(fn)
+    def step(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            connections.close_all()
+
+    return sync_to_async(step, thread_sensitive=False)
+
+
+_render = _read(render)
+
+
+@sync_to_async
+def _authenticated_user(request):
+    """Loads request.user, which queries the session and user tables, and
+    returns it if it's logged in or None otherwise"""
+    return request.user if request.user.is_authenticated else None
+
+
+async def index(request):
+    user = await _authenticated_user(request)
+    if user is None:
+        return HttpResponseRedirect(reverse('login'))
+
+    context = await _read(views.index_context)(user)
+    if context is None:
+        return HttpResponseRedirect(reverse('polls:profile'))
+    return await _render(request, 'polls/index.html', context)
+
+
+async def detail(request, question_id):
+    user = await _authenticated_user(request)
+    if user is None:
+        return HttpResponseRedirect(reverse('login'))
+
+    etag, choice = await _read(views.detail_validators)(request, question_id)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        context = await _read(views.detail_context)(user, question_id, choice)
+        response = await _render(request, 'polls/detail.html', context)
+    return views.set_validators(response, etag)
+
+
+async def vote(request, question_id):
+    user = await _authenticated_user(request)
+    if user is None:
+        return HttpResponseRedirect(reverse('login'))
+
+    try:
+        selected_choice = request.POST['choice']
+    except KeyError:
+        # Redisplay the question voting form.
+        context = await _read(views.missing_choice_context)(user, question_id)
+        return await _render(request, 'polls/detail.html', context)
+
+    choice = await _read(views.parse_choice)(question_id, selected_choice)
+    if choice is None:
+        return HttpResponseBadRequest("invalid choice", content_type="text/plain")
+
+    return HttpResponseRedirect(await sync_to_async(views.save_vote)(user, question_id, choice))
+
+
+async def profile(request):
+    user = await _authenticated_user(request)
+    if user is None:
+        return HttpResponseRedirect(reverse('login'))
+
+    if request.method == "GET":
+        context = await _read(views.profile_context)(user)
+        return await _render(request, 'polls/profile.html', context)
+    elif request.method == "POST":
+        await sync_to_async(views.save_profile)(user, request.POST['gender'], request.POST['gender_preference'])
+        return HttpResponseRedirect(reverse('polls:index'))
@@ -0,0 +1,15 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class SurveyUserBackend(ModelBackend):
+    """ModelBackend that loads the logged in user of every request together with its
+    profile and answer vector, which the survey pages read, in a single query"""
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('profile', 'answer_vector').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Prefetch
+
+from .models import CatalogueGeneration, Choice, Question
+
+GENERATION_KEY = 'polls:catalogue_generation'
+
+
+class Catalogue:
+    """Every question ordered by id, with its choices ordered by id in `question.choices`.
+    Views address questions by their position in this list."""
+
+    def __init__(self, questions, generation):
+        self.questions = questions
+        self.generation = generation  # token used to notice changes made by other processes
+        self.version = _digest(questions)
+        self._positions = {q.id: i for i, q in enumerate(questions)}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, position):
+        return self.questions[position]
+
+    def position_of(self, question_id):
+        """Returns the position of the given question, or -1 if it doesn't exist"""
+        return self._positions.get(question_id, -1)
+
+
+def _digest(questions):
+    """Short hash of the catalogue content, the same in every process"""
+    h = hashlib.sha1()
+    for q in questions:
+        h.update(("%d|%s|%s\n" % (q.id, q.question_text, q.pub_date.isoformat())).encode())
+        for c in q.choices:
+            h.update(("%d|%s|%s|%s\n" % (c.id, c.choice_text, c.choice_image.name if c.choice_image else '',
+                                        json.dumps(c.renditions, sort_keys=True))).encode())
+    return h.hexdigest()[:16]
+
+
+# process local copy of the catalogue
+_memo = None
+
+
+def _shared_cache():
+    alias = getattr(settings, 'POLLS_CONFIG_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def get_catalogue():
+    """Returns the question catalogue, built once and kept in memory until a Question
+    or Choice changes. Changes made by other processes are noticed on the next call,
+    through the generation in the POLLS_CONFIG_CACHE cache if set, otherwise through
+    the CatalogueGeneration row, a single primary key lookup. Views address questions
+    by position, so no process may keep using an outdated copy."""
+    global _memo
+    shared = _shared_cache()
+    if shared is not None:
+        generation = shared.get(GENERATION_KEY)
+        if generation is None:
+            generation = uuid.uuid4().hex
+            shared.add(GENERATION_KEY, generation, timeout=None)
+            generation = shared.get(GENERATION_KEY, generation)
+    else:
+        generation = CatalogueGeneration.current()
+    if _memo is not None and _memo.generation == generation:
+        return _memo
+
+    # read after the generation, so a change committed in between only causes another reload
+    choices = Prefetch('choice_set', queryset=Choice.objects.order_by('id'), to_attr='choices')
+    _memo = Catalogue(list(Question.objects.order_by('id').prefetch_related(choices)), generation)
+    return _memo
+
+
+def invalidate_catalogue():
+    global _memo
+    _memo = None
+    CatalogueGeneration.bump()
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+# session engines that read sessions from SESSION_CACHE_ALIAS
+CACHED_SESSION_ENGINES = ('django.contrib.sessions.backends.cache', 'django.contrib.sessions.backends.cached_db')
+
+# cache backends whose entries other processes never see
+PRIVATE_CACHE_BACKENDS = ('django.core.cache.backends.locmem.LocMemCache',
+                          'django.core.cache.backends.dummy.DummyCache')
+
+
+@register()
+def check_session_cache(app_configs, **kwargs):
+    """Sessions stay in their cache for as long as they last, so with a cache private to
+    each process a logout would leave the session valid in the others"""
+    if settings.SESSION_ENGINE not in CACHED_SESSION_ENGINES:
+        return []
+    backend = settings.CACHES.get(settings.SESSION_CACHE_ALIAS, {}).get('BACKEND')
+    if backend in PRIVATE_CACHE_BACKENDS:
+        return [Error("sessions are cached in %r, which is private to each process" % settings.SESSION_CACHE_ALIAS,
+                      hint="Point POLLS_SESSION_CACHE to a cache shared by every process, like memcached.",
+                      id='polls.E001')]
+    return []
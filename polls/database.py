@@ -0,0 +1,64 @@
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+
+from .routers import read_database
+
+logger = logging.getLogger('polls')
+
+# what SQLite does without POLLS_SQLITE_PRAGMAS, for comparison in `manage.py benchmarkpolls`
+SQLITE_DEFAULT_PRAGMAS = {
+    'journal_mode': 'delete',
+    'synchronous': 'full',
+    'mmap_size': 0,
+    'cache_size': -2000,
+    'busy_timeout': 5000,
+}
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """connection_created receiver that sets POLLS_SQLITE_PRAGMAS on every new SQLite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = dict(getattr(settings, 'POLLS_SQLITE_PRAGMAS', {}))
+    with connection.cursor() as cursor:
+        # wait for locks while setting the rest
+        if 'busy_timeout' in pragmas:
+            cursor.execute("PRAGMA busy_timeout = %s" % pragmas.pop('busy_timeout'))
+        # the journal mode is stored in the database file, and changing it needs exclusive
+        # access. The read database keeps the one of its snapshots, see `manage.py snapshotdb`
+        if connection.alias == read_database():
+            pragmas.pop('journal_mode', None)
+        if 'journal_mode' in pragmas:
+            cursor.execute("PRAGMA journal_mode")
+            if cursor.fetchone()[0] != str(pragmas['journal_mode']).lower():
+                cursor.execute("PRAGMA journal_mode = %s" % pragmas['journal_mode'])
+            del pragmas['journal_mode']
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+
+
+def retry_if_locked(fn):
+    """Runs fn again when SQLite answers "database is locked", up to
+    POLLS_WRITE_RETRIES times with a growing random delay. That happens when the
+    busy timeout runs out, or right away when two transactions that read first
+    both try to write. fn must be safe to repeat and is never retried inside an
+    outer transaction, which would be rolled back anyway."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        retries = getattr(settings, 'POLLS_WRITE_RETRIES', 3)
+        for attempt in range(retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except OperationalError as e:
+                if 'locked' not in str(e) or attempt == retries or transaction.get_connection().in_atomic_block:
+                    raise
+                logger.warning("database is locked in %s, retrying", fn.__name__)
+                time.sleep(random.uniform(0.01, 0.05) * 2 ** attempt)
+
+    return wrapper
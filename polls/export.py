@@ -0,0 +1,72 @@
+import csv
+
+from django.db.models import Q
+
+from .catalogue import get_catalogue
+from .matching import percent
+from .models import AnswerVector, Match
+from .routers import replica_reads
+
+TABLES = ['answers', 'matches']
+
+# rows read per query
+BATCH_SIZE = 2000
+
+
+class _Echo:
+    """File-like object returning what is written to it, so csv.writer can build lines for a generator"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(table):
+    """Yields the given table as CSV text, one line at a time. Rows are read in
+    batches of BATCH_SIZE, each one a short query starting after the last row seen,
+    so memory use is constant and no read lock is held while the lines are sent.
+    Rows come from POLLS_READ_DATABASE when set."""
+    writer = csv.writer(_Echo())
+    rows = answer_rows() if table == 'answers' else match_rows()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def answer_rows():
+    """One row per user with its picked choice index for every question, empty if unanswered"""
+    questions = get_catalogue().questions
+    yield ['user_id', 'username', 'completed'] + ['q%d' % q.id for q in questions]
+
+    vectors = AnswerVector.objects.order_by('user_id').values_list('user_id', 'user__username', 'completed', 'answers')
+    last = 0
+    while True:
+        with replica_reads():
+            batch = list(vectors.filter(user_id__gt=last)[:BATCH_SIZE])
+        for user_id, username, completed, answers in batch:
+            vector = AnswerVector(answers=answers)
+            yield [user_id, username, int(completed)] + \
+                  ['' if c == -1 else c for c in vector.choices(len(questions))]
+        if len(batch) < BATCH_SIZE:
+            return
+        last = batch[-1][0]
+
+
+def match_rows():
+    """One row per entry of the stored match lists, best first for every user"""
+    question_count = len(get_catalogue())
+    yield ['user_id', 'candidate_id', 'coincidences', 'score']
+
+    matches = Match.objects.order_by('user_id', '-coincidences', 'candidate_id') \
+        .values_list('user_id', 'candidate_id', 'coincidences')
+    last = (0, 0, 0)
+    while True:
+        user_id, candidate_id, coincidences = last
+        after = Q(user_id__gt=user_id) | Q(user_id=user_id, coincidences__lt=coincidences) | \
+            Q(user_id=user_id, coincidences=coincidences, candidate_id__gt=candidate_id)
+        with replica_reads():
+            batch = list(matches.filter(after)[:BATCH_SIZE])
+        for user_id, candidate_id, coincidences in batch:
+            yield [user_id, candidate_id, coincidences,
+                   percent(coincidences, question_count) if question_count else 0]
+        if len(batch) < BATCH_SIZE:
+            return
+        last = batch[-1]
@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+from .instrumentation import timed
+from .matching import get_matches
+
+GENERATION_KEY = 'polls:matches_generation'
+
+
+class LRUCache:
+    """Thread safe mapping holding at most `max_size` entries, dropping the least
+    recently used one when full. Entries also expire after `timeout` seconds."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, monotonic expiry time)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if time.monotonic() >= entry[1]:
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# rendered match lists by user id, as (stamp, html, match count)
+fragments = LRUCache(getattr(settings, 'POLLS_FRAGMENT_CACHE_SIZE', 1000))
+
+# token of this process, replaced whenever something shown in every list changes
+_local_generation = uuid.uuid4().hex
+
+
+def _shared_cache():
+    alias = getattr(settings, 'POLLS_CONFIG_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def _generation():
+    shared = _shared_cache()
+    if shared is None:
+        return _local_generation
+    generation = shared.get(GENERATION_KEY)
+    if generation is None:
+        shared.add(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+        generation = shared.get(GENERATION_KEY, _local_generation)
+    return generation
+
+
+def invalidate_match_fragments():
+    """Drops every cached list, for changes that aren't tracked by the per user
+    matches_version: the site configuration or the name and email of the users"""
+    global _local_generation
+    _local_generation = uuid.uuid4().hex
+    fragments.clear()
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def match_fragment(user, vector, catalogue, cfg):
+    """Returns the rendered list of the best matches of user, and how many it shows.
+    It's reused until the Match list of user, the questions or the configuration
+    change, for POLLS_FRAGMENT_TIMEOUT seconds at most."""
+    stamp = (vector.matches_version, catalogue.version, _generation())
+    entry = fragments.get(user.id)
+    if entry is not None and entry[0] == stamp:
+        return entry[1], entry[2]
+
+    with timed('matching'):
+        matches = get_matches(user, len(catalogue), cfg.afinidad_cantidad_gente)
+    html = render_to_string('polls/matches.html', {'matches': matches, 'cfg': cfg})
+    fragments.set(user.id, (stamp, html, len(matches)), getattr(settings, 'POLLS_FRAGMENT_TIMEOUT', 60))
+    return html, len(matches)
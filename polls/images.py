@@ -0,0 +1,92 @@
+import hashlib
+import io
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+logger = logging.getLogger('polls')
+
+# image fields that get renditions, by model name
+IMAGE_FIELDS = {
+    'choice': ['choice_image'],
+    'appconfig': ['imagen_logo', 'imagen_fondo', 'imagen_principal'],
+}
+
+
+def _widths():
+    return getattr(settings, 'POLLS_IMAGE_WIDTHS', [320, 640, 1280])
+
+
+def make_renditions(field_file):
+    """Resizes the image to every POLLS_IMAGE_WIDTHS width smaller than itself, plus its
+    own width up to the largest of them, and saves each one as WebP named after the
+    hash of its content, so the files never change and can be cached forever. Returns
+    the renditions as a list of [width, storage name], narrowest first."""
+    with field_file.open('rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+    widths = sorted({w for w in _widths() if w < image.width} | {min(image.width, max(_widths()))})
+    renditions = []
+    for width in widths:
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, 'WEBP', quality=getattr(settings, 'POLLS_IMAGE_QUALITY', 80), method=6)
+        content = buffer.getvalue()
+
+        name = 'renditions/%s-%d.webp' % (hashlib.sha256(content).hexdigest()[:16], width)
+        if not field_file.storage.exists(name):
+            name = field_file.storage.save(name, ContentFile(content))
+        renditions.append([width, name])
+    return renditions
+
+
+def refresh_renditions(instance, force=False):
+    """Builds the renditions of the image fields of instance whose file changed since
+    they were made, and saves them in its `renditions` field. Returns whether any changed."""
+    renditions = dict(instance.renditions or {})
+    for field in IMAGE_FIELDS[instance._meta.model_name]:
+        image = getattr(instance, field)
+        current = renditions.get(field)
+        if not image:
+            if current is not None:
+                del renditions[field]
+            continue
+        if not force and current is not None and current['source'] == image.name:
+            continue
+        try:
+            renditions[field] = {'source': image.name, 'sizes': make_renditions(image)}
+        except (OSError, ValueError) as e:  # missing or not an image, the original is served
+            logger.warning("can't make renditions of %s: %s", image.name, e)
+            renditions.pop(field, None)
+
+    if renditions == (instance.renditions or {}):
+        return False
+    instance.renditions = renditions
+    instance.save(update_fields=['renditions'])
+    return True
+
+
+def srcset(instance, field):
+    """srcset attribute value for the renditions of the given image field, or '' if there are none"""
+    rendition = (instance.renditions or {}).get(field)
+    image = getattr(instance, field)
+    if not rendition or not image or rendition['source'] != image.name:
+        return ''
+    return ', '.join('%s %dw' % (image.storage.url(name), width) for width, name in rendition['sizes'])
+
+
+def rendition_url(instance, field):
+    """URL of the widest rendition of the given image field, or of the original if there are none"""
+    rendition = (instance.renditions or {}).get(field)
+    image = getattr(instance, field)
+    if not image:
+        return ''
+    if not rendition or rendition['source'] != image.name:
+        return image.url
+    return image.storage.url(rendition['sizes'][-1][1])
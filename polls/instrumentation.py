@@ -0,0 +1,231 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError, transaction
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger('polls.requests')
+
+# upper bounds of the histogram buckets, in milliseconds (or queries, for the query count).
+# The last one catches everything above.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10 ** 9]
+
+METRICS = ['total', 'db', 'queries', 'template', 'matching']
+
+_current = contextvars.ContextVar('polls_request_metrics', default=None)
+
+
+class RequestMetrics:
+    """Numbers collected while serving one request. Times are in milliseconds."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.timers = {}
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db += (time.perf_counter() - start) * 1000.0
+            self.queries += 1
+
+    def add(self, name, ms):
+        self.timers[name] = self.timers.get(name, 0.0) + ms
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver that adds the queries of the connection to the
+    request being served, even when they run in a sync_to_async thread"""
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def _time_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.execute_wrapper(execute, sql, params, many, context)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Adds the time spent in the block to the `name` timer of the current request, if any"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add(name, (time.perf_counter() - start) * 1000.0)
+
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+        self.origin = template.origin
+
+    def render(self, context=None, request=None):
+        with timed('template'):
+            return self.template.render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django template backend that reports render time to the instrumentation middleware"""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+class Histograms:
+    """Per endpoint and metric bucket counts not yet flushed to the database"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, endpoint, metric, value):
+        bound = BUCKETS[min(bisect.bisect_left(BUCKETS, value), len(BUCKETS) - 1)]
+        key = (endpoint, metric, bound)
+        with self.lock:
+            self.pending[key] = self.pending.get(key, 0) + 1
+
+    def due(self):
+        interval = getattr(settings, 'POLLS_METRICS_FLUSH_INTERVAL', 30)
+        return time.monotonic() - self.last_flush >= interval
+
+    def flush_if_due(self):
+        if self.due():
+            self.flush()
+
+    def flush(self):
+        """Adds the pending counts to the TimingBucket table, shared by every process.
+        Never raises: it runs after the response is built, and a failed flush keeps the
+        counts for the next one."""
+        from .models import TimingBucket
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return
+
+        try:
+            with transaction.atomic():
+                TimingBucket.add(pending)
+        except DatabaseError:
+            logger.warning("could not flush the request histograms", exc_info=True)
+            with self.lock:
+                for key, count in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + count
+
+
+histograms = Histograms()
+
+
+class InstrumentationMiddleware:
+    """Measures query count, DB time, template render time and matching time of every
+    request. Sends them in a Server-Timing header and a JSON log line, and adds them
+    to the per endpoint histograms dumped by `manage.py dumpmetrics` and /metrics/.
+    Works in front of both sync and async views."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the instance as a coroutine function, as Django's own middleware do
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, metrics, start)
+        histograms.flush_if_due()
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._record(request, response, metrics, start)
+        if histograms.due():
+            await sync_to_async(histograms.flush)()
+        return response
+
+    def _record(self, request, response, metrics, start):
+        total = (time.perf_counter() - start) * 1000.0
+
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match is not None else 'unresolved'
+        values = {'total': total, 'db': metrics.db, 'queries': metrics.queries}
+        values.update(metrics.timers)
+
+        response['Server-Timing'] = ', '.join(
+            ['db;dur=%.1f;desc="%d queries"' % (metrics.db, metrics.queries)] +
+            ['%s;dur=%.1f' % (name, ms) for name, ms in metrics.timers.items()] +
+            ['total;dur=%.1f' % total])
+        logger.info(json.dumps(dict(values, endpoint=endpoint, method=request.method,
+                                    status=response.status_code)))
+
+        for metric, value in values.items():
+            histograms.record(endpoint, metric, value)
+
+
+def percentile(buckets, fraction):
+    """Upper bound of the bucket holding the given fraction of the samples"""
+    total = sum(count for _, count in buckets)
+    seen = 0
+    for bound, count in sorted(buckets):
+        seen += count
+        if seen >= fraction * total:
+            return bound
+    return 0
+
+
+def report():
+    """Returns the histograms of every endpoint as text, one line per endpoint and metric"""
+    from .models import TimingBucket
+
+    histograms.flush()
+    table = {}
+    for b in TimingBucket.objects.order_by('endpoint', 'metric', 'upper_bound'):
+        table.setdefault((b.endpoint, b.metric), []).append((b.upper_bound, b.count))
+
+    lines = ["%-28s %-10s %8s %8s %8s %8s" % ("endpoint", "metric", "count", "p50", "p95", "p99")]
+    for endpoint, metric in sorted(table, key=lambda key: (key[0], _metric_order(key[1]))):
+        buckets = table[(endpoint, metric)]
+        lines.append("%-28s %-10s %8d %8g %8g %8g" % (
+            endpoint, metric, sum(count for _, count in buckets),
+            percentile(buckets, 0.5), percentile(buckets, 0.95), percentile(buckets, 0.99)))
+    return '\n'.join(lines) + '\n'
+
+
+def _metric_order(metric):
+    return METRICS.index(metric) if metric in METRICS else len(METRICS)
@@ -0,0 +1,96 @@
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from .catalogue import get_catalogue
+from .instrumentation import timed
+from .matching import refresh_matches, update_matches
+from .models import AppConfig, MatchJob
+
+logger = logging.getLogger('polls')
+
+# a job claimed for longer than this is considered abandoned by a dead worker
+CLAIM_TIMEOUT = datetime.timedelta(minutes=5)
+
+
+def enqueue_match_update(user):
+    """Queues a recompute of the matches of user and of its place in everyone else's
+    matches. Used after its answers or its profile changed."""
+    if MatchJob.objects.filter(user=user).update(requested_at=timezone.now(), update_others=True) == 0:
+        _create_job(user, update_others=True)
+    _run_inline()
+
+
+def enqueue_match_refresh(user):
+    """Queues a recompute of the matches of user only, unless it's already queued."""
+    if not MatchJob.objects.filter(user=user).exists():
+        _create_job(user, update_others=False)
+    _run_inline()
+
+
+def _create_job(user, update_others):
+    try:
+        MatchJob.objects.create(user=user, update_others=update_others)
+    except IntegrityError:  # someone queued it meanwhile
+        if update_others:
+            MatchJob.objects.filter(user=user).update(requested_at=timezone.now(), update_others=True)
+
+
+def _run_inline():
+    if getattr(settings, 'POLLS_MATCH_JOBS_INLINE', False):
+        run_pending_jobs()
+
+
+def claim_next_job():
+    """Marks the oldest pending job as taken by this worker and returns it, or None"""
+    abandoned = timezone.now() - CLAIM_TIMEOUT
+    pending = MatchJob.objects.filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=abandoned))
+    for job in pending.select_related('user').order_by('requested_at')[:10]:
+        claimed_at = timezone.now()
+        # only one worker can win the update, the rest try the next job
+        if MatchJob.objects.filter(pk=job.pk, claimed_at=job.claimed_at).update(claimed_at=claimed_at) == 1:
+            job.claimed_at = claimed_at
+            return job
+    return None
+
+
+def run_job(job):
+    questions = get_catalogue().questions
+    if questions:
+        cfg = AppConfig.get()
+        with timed('matching'):
+            if job.update_others:
+                update_matches(job.user, questions, cfg.afinidad_cantidad_gente, gender_filter=cfg.pedir_genero)
+            else:
+                refresh_matches(job.user, questions, cfg.afinidad_cantidad_gente, gender_filter=cfg.pedir_genero)
+
+    # done, unless it was requested again while running: then release it to run once more
+    deleted, _ = MatchJob.objects.filter(pk=job.pk, requested_at=job.requested_at).delete()
+    if not deleted:
+        MatchJob.objects.filter(pk=job.pk).update(claimed_at=None)
+
+
+def run_pending_jobs():
+    """Runs jobs until the queue is empty. Returns how many ran."""
+    count = 0
+    job = claim_next_job()
+    while job is not None:
+        try:
+            run_job(job)
+        except Exception:  # leave it claimed, it will be retried after CLAIM_TIMEOUT
+            logger.exception("match job failed for user " + str(job.user))
+        count += 1
+        job = claim_next_job()
+    return count
+
+
+def work(poll_interval=1.0):
+    """Worker loop: runs queued jobs forever, sleeping poll_interval seconds when idle"""
+    while True:
+        if run_pending_jobs() == 0:
+            time.sleep(poll_interval)
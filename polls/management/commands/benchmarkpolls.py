@@ -0,0 +1,160 @@
+import logging
+import random
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from polls.catalogue import get_catalogue
+from polls.database import SQLITE_DEFAULT_PRAGMAS
+from polls.matching import lsh_bands, rebuild_lsh_index, refresh_matches
+from polls.models import AppConfig
+
+SCENARIOS = ['index', 'detail', 'vote', 'signup', 'matching', 'contention']
+
+
+class Command(BaseCommand):
+    help = ("Measures query count, p50/p95 latency and peak memory of the hot paths against "
+            "the current database. Fill it with populatepolls first; vote and signup write to it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rounds', type=int, default=50, help="Measured runs per scenario")
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help="Comma separated subset of " + ', '.join(SCENARIOS))
+        parser.add_argument('--modes', default='exact,approximate',
+                            help="Comma separated matching modes for the matching scenario")
+        parser.add_argument('--threads', type=int, default=8,
+                            help="Concurrent voters in the contention scenario")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        questions = get_catalogue()
+        users = list(User.objects.filter(answer_vector__completed=True).order_by('id')[:1000])
+        if len(questions) == 0 or len(users) < 2:
+            raise CommandError("no data to benchmark, run populatepolls first")
+
+        self.rng = random.Random(options['seed'])
+        self.user = users[0]
+        self.client = Client()
+        self.client.force_login(self.user)
+        cfg = AppConfig.get()
+        refresh_matches(self.user, questions.questions, cfg.afinidad_cantidad_gente, cfg.pedir_genero)
+
+        logging.getLogger('polls').setLevel(logging.WARNING)  # one line per vote would flood the output
+        self.stdout.write("%d questions, %d users that completed the poll" %
+                          (len(questions), User.objects.filter(answer_vector__completed=True).count()))
+        self.stdout.write("%-22s %8s %10s %10s %12s" % ("scenario", "queries", "p50 ms", "p95 ms", "peak KiB"))
+
+        for name in options['scenarios'].split(','):
+            if name == 'index':
+                self._run(name, lambda i: self._request('get', '/', 200), options['rounds'])
+            elif name == 'detail':
+                self._run(name, lambda i: self._request(
+                    'get', '/%d/' % self.rng.randrange(len(questions)), 200), options['rounds'])
+            elif name == 'vote':
+                self._run(name, lambda i: self._vote(questions), options['rounds'])
+            elif name == 'signup':
+                self._run(name, self._signup, options['rounds'])
+            elif name == 'matching':
+                for mode in options['modes'].split(','):
+                    with override_settings(POLLS_MATCHING_MODE=mode):
+                        if lsh_bands():
+                            rebuild_lsh_index(questions.questions)
+
+                    def match(i, mode=mode):
+                        with override_settings(POLLS_MATCHING_MODE=mode):
+                            refresh_matches(users[i % len(users)], questions.questions,
+                                            cfg.afinidad_cantidad_gente, cfg.pedir_genero)
+                    self._run("matching (%s)" % mode, match, options['rounds'])
+            elif name == 'contention':
+                voters = users[:options['threads']]
+                self._contention("contention (default)", SQLITE_DEFAULT_PRAGMAS, voters, questions, options['rounds'])
+                self._contention("contention (tuned)", settings.POLLS_SQLITE_PRAGMAS, voters, questions,
+                                 options['rounds'])
+            else:
+                raise CommandError("unknown scenario: " + name)
+
+    def _request(self, method, path, expected_status, data=None):
+        response = getattr(self.client, method)(path, data)
+        if response.status_code != expected_status:
+            raise CommandError("%s %s returned %d" % (method.upper(), path, response.status_code))
+
+    def _vote(self, questions):
+        position = self.rng.randrange(len(questions))
+        choice = self.rng.randrange(max(len(questions[position].choices), 1))
+        self._request('post', '/%d/vote/' % position, 302, {'choice': str(choice)})
+
+    def _signup(self, i):
+        username = "signup%d" % self.rng.randrange(10 ** 12)
+        Client().post('/signup/', {'username': username, 'email': username + '@example.com',
+                                   'password1': 'benchmark', 'password2': 'benchmark'})
+        if not User.objects.filter(username=username).exists():
+            raise CommandError("signup failed for " + username)
+
+    def _run(self, name, fn, rounds):
+        fn(-1)  # warm up caches and lazy imports
+        timings = []
+        queries = []
+        for i in range(rounds):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                fn(i)
+                timings.append(time.perf_counter() - start)
+            queries.append(len(ctx.captured_queries))
+
+        # tracing slows everything down, so memory is measured in a separate run
+        tracemalloc.start()
+        fn(rounds)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stdout.write("%-22s %8.1f %10.2f %10.2f %12.1f" % (
+            name, float(np.mean(queries)), float(np.percentile(timings, 50)) * 1000.0,
+            float(np.percentile(timings, 95)) * 1000.0, peak / 1024.0))
+
+    def _contention(self, name, pragmas, voters, questions, rounds):
+        """Every voter votes `rounds` times at once from its own thread and connection,
+        with the given SQLite pragmas. Reports the vote latency and the votes per second."""
+        timings = []
+        failures = []
+
+        def vote(user, seed):
+            rng = random.Random(seed)
+            client = Client()
+            client.force_login(user)
+            try:
+                for i in range(rounds):
+                    position = rng.randrange(len(questions))
+                    start = time.perf_counter()
+                    try:
+                        client.post('/%d/vote/' % position,
+                                    {'choice': str(rng.randrange(max(len(questions[position].choices), 1)))})
+                        timings.append(time.perf_counter() - start)
+                    except OperationalError:
+                        failures.append(i)
+            finally:
+                connections.close_all()
+
+        connection.close()  # the pragmas apply to new connections
+        with override_settings(POLLS_SQLITE_PRAGMAS=pragmas):
+            connection.ensure_connection()  # switches the journal mode before the voters connect
+            threads = [threading.Thread(target=vote, args=(user, self.rng.random())) for user in voters]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            connection.close()
+
+        self.stdout.write("%-22s %8s %10.2f %10.2f %12s   %.0f votes/s, %d failed" % (
+            name, '-', float(np.percentile(timings, 50)) * 1000.0 if timings else 0.0,
+            float(np.percentile(timings, 95)) * 1000.0 if timings else 0.0, '-',
+            len(timings) / elapsed, len(failures)))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from polls.instrumentation import report
+from polls.models import TimingBucket
+
+
+class Command(BaseCommand):
+    help = "Prints the per endpoint timing histograms collected by the instrumentation middleware"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Clear the histograms after printing them")
+
+    def handle(self, *args, **options):
+        self.stdout.write(report(), ending='')
+        if options['reset']:
+            TimingBucket.objects.all().delete()
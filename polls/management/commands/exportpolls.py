@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from polls.export import TABLES, csv_lines
+
+
+class Command(BaseCommand):
+    help = ("Writes a table as CSV: 'answers' has one row per user and one column per question, "
+            "'matches' one row per entry of the stored match lists")
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', nargs='?', default='answers', choices=TABLES)
+        parser.add_argument('--output', help="File to write, defaults to the standard output")
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            for line in csv_lines(options['table']):
+                self.stdout.write(line, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            for line in csv_lines(options['table']):
+                f.write(line)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.catalogue import get_catalogue
+from polls.matching import lsh_bands, rebuild_lsh_index
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the LSH keys of every user that completed the poll, used by the "
+            "'approximate' matching mode. Run it after turning the mode on or changing POLLS_LSH_*.")
+
+    def handle(self, *args, **options):
+        if not lsh_bands():
+            raise CommandError("set POLLS_MATCHING_MODE = 'approximate' and POLLS_LSH_BANDS > 0 first")
+        count = rebuild_lsh_index(get_catalogue().questions)
+        self.stdout.write("%d users indexed" % count)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from polls.images import refresh_renditions
+from polls.models import AppConfig, Choice
+
+
+class Command(BaseCommand):
+    help = ("Makes the WebP renditions of the choice and configuration images uploaded before "
+            "they were made on upload, or of every image with --force")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Remake them all, e.g. after changing POLLS_IMAGE_WIDTHS")
+
+    def handle(self, *args, **options):
+        updated = 0
+        for instance in list(AppConfig.objects.all()) + \
+                list(Choice.objects.exclude(choice_image='').exclude(choice_image=None)):
+            updated += refresh_renditions(instance, force=options['force'])
+        self.stdout.write("updated the renditions of %d objects" % updated)
@@ -0,0 +1,84 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from polls.approximate import band_keys
+from polls.catalogue import get_catalogue
+from polls.matching import AnswerMatrix, score_candidates, top_k
+from polls.models import AnswerVector, AppConfig
+from polls.routers import replica_reads
+
+
+def _percentile(values, p):
+    return float(np.percentile(values, p)) * 1000.0 if values else 0.0
+
+
+class Command(BaseCommand):
+    help = ("Compares the recall and latency of the exact and approximate matching modes. "
+            "Approximate lookups run against an in-memory copy of the LSH index.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=int, default=50, help="Users to compute matches for")
+        parser.add_argument('--limit', type=int, help="Matches per user, defaults to AppConfig")
+        parser.add_argument('--bands', default='2,4,8,16',
+                            help="Comma separated LSH band counts to try in approximate mode")
+        parser.add_argument('--band-size', type=int, default=4, help="Questions per LSH band")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        questions = get_catalogue().questions
+        with replica_reads():
+            matrix = AnswerMatrix.load(questions, AnswerVector.objects.filter(completed=True))
+        if not questions or len(matrix.user_ids) < 2:
+            raise CommandError("need at least two users that completed the poll")
+
+        limit = options['limit'] or AppConfig.get().afinidad_cantidad_gente
+        rows = random.Random(options['seed']).sample(range(len(matrix.user_ids)),
+                                                     min(options['sample'], len(matrix.user_ids)))
+        self.stdout.write("%d users, %d questions, top %d, %d sampled" %
+                          (len(matrix.user_ids), len(questions), limit, len(rows)))
+
+        exact = {}
+        timings = []
+        for row in rows:
+            start = time.perf_counter()
+            coincidences, eligible = score_candidates(matrix, row)
+            best = top_k(coincidences, eligible, limit)
+            timings.append(time.perf_counter() - start)
+            # everyone tied with the last entry is an equally good answer
+            cutoff = coincidences[best[-1]] if len(best) else 0
+            exact[row] = (set(np.flatnonzero(eligible & (coincidences >= cutoff)).tolist()), len(best))
+        self._report("exact", timings, 1.0, len(matrix.user_ids))
+
+        question_ids = [q.id for q in questions]
+        for bands in [int(b) for b in options['bands'].split(',')]:
+            # sorted keys of every band, standing in for the (band, key) index of LshBucket
+            keys = band_keys(matrix.choices, question_ids, bands, options['band_size'])
+            index = []
+            for band in range(bands):
+                order = np.argsort(keys[:, band], kind='stable')
+                index.append((keys[order, band], order))
+
+            timings = []
+            recall = []
+            scored = []
+            for row in rows:
+                start = time.perf_counter()
+                found = [order[np.searchsorted(sorted_keys, key):np.searchsorted(sorted_keys, key, side='right')]
+                         for (sorted_keys, order), key in zip(index, keys[row])]
+                candidates = np.unique(np.concatenate(found))
+                coincidences = (matrix.choices[candidates] == matrix.choices[row]).sum(axis=1)
+                best = candidates[top_k(coincidences, candidates != row, limit)]
+                timings.append(time.perf_counter() - start)
+                scored.append(len(candidates))
+                expected, size = exact[row]
+                if size:
+                    recall.append(min(len(expected & set(best.tolist())), size) / size)
+            self._report("approximate, %d bands of %d" % (bands, options['band_size']), timings,
+                         float(np.mean(recall)) if recall else 1.0, float(np.mean(scored)))
+
+    def _report(self, label, timings, recall, scored):
+        self.stdout.write("%-32s recall %.3f   p50 %.2fms   p95 %.2fms   %d scored" %
+                          (label, recall, _percentile(timings, 50), _percentile(timings, 95), scored))
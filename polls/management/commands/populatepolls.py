@@ -0,0 +1,86 @@
+import random
+from array import array
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from polls.catalogue import invalidate_catalogue
+from polls.matching import discard_shared_matrix, lsh_bands, rebuild_lsh_index
+from polls.models import Answer, AnswerVector, AppConfig, Choice, ChoiceCount, Profile, Question
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = "Fills the database with random questions, users, profiles and answers, for benchmarking"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--questions', type=int, default=20)
+        parser.add_argument('--choices', type=int, default=4, help="Choices per question")
+        parser.add_argument('--completed', type=float, default=0.9,
+                            help="Fraction of the users that answer every question")
+        parser.add_argument('--password', default='benchmark', help="Password of every generated user")
+        parser.add_argument('--prefix', default='bench', help="Prefix of the generated usernames")
+        parser.add_argument('--seed', type=int, default=0)
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        if AppConfig.get() is None:
+            AppConfig.objects.create(imagen_logo='logo.png', imagen_fondo='fondo.png',
+                                     imagen_principal='principal.png')
+
+        now = timezone.now()
+        start = Question.objects.count()
+        Question.objects.bulk_create([Question(question_text="Pregunta %d" % (start + i), pub_date=now)
+                                      for i in range(options['questions'])])
+        new_questions = list(Question.objects.order_by('id')[start:])
+        Choice.objects.bulk_create([Choice(question=q, choice_text="Opción %d" % c)
+                                    for q in new_questions for c in range(options['choices'])],
+                                   batch_size=BATCH_SIZE)
+        invalidate_catalogue()
+
+        # same ordering as the catalogue, so vector positions match
+        questions = list(Question.objects.order_by('id').prefetch_related('choice_set'))
+        choice_counts = [len(q.choice_set.all()) for q in questions]
+
+        first_id = (User.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        password = make_password(options['password'])  # hashing once keeps generation fast
+        users = [User(username="%s%d" % (options['prefix'], first_id + i), password=password)
+                 for i in range(options['users'])]
+        User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+        users = list(User.objects.filter(id__gte=first_id).order_by('id'))
+
+        profiles, answers, vectors = [], [], []
+        for user in users:
+            profiles.append(Profile(user=user, gender=rng.choice('MF'), gender_preference=rng.choice('MF')))
+            answered = len(questions) if rng.random() < options['completed'] else rng.randrange(len(questions) + 1)
+            packed = array('H', [0] * len(questions))
+            for position in range(answered):
+                if choice_counts[position] == 0:
+                    continue
+                choice = rng.randrange(choice_counts[position])
+                answers.append(Answer(user=user, question=questions[position], choice=choice))
+                packed[position] = choice + 1
+            vectors.append(AnswerVector(user=user, answers=packed.tobytes(),
+                                        completed=len(packed) > 0 and 0 not in packed))
+
+        Profile.objects.bulk_create(profiles, batch_size=BATCH_SIZE)
+        Answer.objects.bulk_create(answers, batch_size=BATCH_SIZE)
+        votes = {}
+        for answer in answers:
+            votes[(answer.question.id, answer.choice)] = votes.get((answer.question.id, answer.choice), 0) + 1
+        ChoiceCount.add(votes)
+        AnswerVector.objects.bulk_create(vectors, batch_size=BATCH_SIZE)
+        # scores against the existing users changed
+        AnswerVector.objects.update(matches_stale=True)
+        transaction.on_commit(discard_shared_matrix)
+        if lsh_bands():
+            rebuild_lsh_index(questions)
+
+        self.stdout.write("created %d questions, %d users and %d answers" %
+                          (len(new_questions), len(users), len(answers)))
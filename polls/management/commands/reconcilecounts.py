@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from polls.models import ChoiceCount
+
+
+class Command(BaseCommand):
+    help = ("Recounts the votes of every choice from the answers and fixes the result counters "
+            "that drifted. Meant to run nightly, it reads the whole Answer table.")
+
+    def handle(self, *args, **options):
+        fixed = ChoiceCount.reconcile()
+        self.stdout.write("%d counters fixed" % fixed)
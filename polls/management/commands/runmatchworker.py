@@ -0,0 +1,48 @@
+import multiprocessing
+import signal
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from polls.jobs import run_pending_jobs, work
+
+
+class Command(BaseCommand):
+    help = "Runs the workers that recompute matches queued by the vote and profile views"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help="Worker processes to run")
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help="Seconds to wait before polling again when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Run the queued jobs and exit")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            count = run_pending_jobs()
+            self.stdout.write("ran %d job(s)" % count)
+            return
+
+        if options['workers'] <= 1:
+            work(options['interval'])
+            return
+
+        # children must open their own connections, never share the parent's. They aren't
+        # daemons, which can't start the POLLS_MATCHING_PROCESSES pool, so the parent
+        # terminates them itself when it stops.
+        connections.close_all()
+        processes = [multiprocessing.Process(target=work, args=(options['interval'],))
+                     for _ in range(options['workers'])]
+        for p in processes:
+            p.start()
+
+        # stop the children along with this process
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for p in processes:
+                p.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for p in processes:
+                p.terminate()
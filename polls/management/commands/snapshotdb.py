@@ -0,0 +1,35 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from polls.routers import read_database
+
+
+class Command(BaseCommand):
+    help = ("Copies the default SQLite database over the one of POLLS_READ_DATABASE, "
+            "to refresh the copy matching and the exports read from. Run it periodically.")
+
+    def handle(self, *args, **options):
+        alias = read_database()
+        if alias is None:
+            raise CommandError("POLLS_READ_DATABASE is not set")
+        source, target = connections[DEFAULT_DB_ALIAS], connections[alias]
+        if source.vendor != 'sqlite' or target.vendor != 'sqlite':
+            raise CommandError("only SQLite databases can be snapshotted, replicate other ones with their own tools")
+
+        # the backup API copies a consistent snapshot while the site keeps writing,
+        # and the new file replaces the old one at once for the readers
+        path = str(target.settings_dict['NAME'])
+        partial = path + '.partial'
+        source.ensure_connection()
+        copy = source.Database.connect(partial)
+        try:
+            source.connection.backup(copy)
+            # a WAL file left by the replaced copy must never be applied to the new one
+            copy.execute("PRAGMA journal_mode = delete")
+        finally:
+            copy.close()
+        target.close()
+        os.replace(partial, path)
+        self.stdout.write("copied %s to %s" % (source.settings_dict['NAME'], path))
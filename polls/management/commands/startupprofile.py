@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Boots the site in a fresh interpreter, as a new web worker does, and reports how "
+            "long loading the apps, the URLconf and the WSGI/ASGI handlers takes. Fails if any "
+            "of them opens a database connection or runs a query.")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE',
+                                                                      settings.SETTINGS_MODULE))
+        result = subprocess.run([sys.executable, '-m', 'polls.startup'], env=env,
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        profile = json.loads(result.stdout.strip().splitlines()[-1])
+
+        for name, ms in profile['timings'].items():
+            self.stdout.write("%-8s %8.1f ms" % (name, ms))
+        self.stdout.write("%-8s %8.1f ms" % ("total", sum(profile['timings'].values())))
+
+        if profile['connections'] or profile['queries']:
+            for c in profile['connections']:
+                self.stderr.write("connection to %s opened while loading %s" % (c['alias'], c['phase']))
+            for q in profile['queries']:
+                self.stderr.write("query while loading %s: %s" % (q['phase'], q['sql']))
+            raise CommandError("the database is accessed during startup")
+        self.stdout.write("no queries during startup")
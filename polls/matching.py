@@ -0,0 +1,443 @@
+import hashlib
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+
+from . import sharedmatrix
+from .approximate import band_keys
+from .database import retry_if_locked
+from .models import AnswerVector, LshBucket, Match, Profile
+from .routers import read_database, replica_reads
+
+UNANSWERED = -1  # matrix cell value for questions the user didn't answer
+
+# users indexed per batch by rebuild_lsh_index()
+LSH_BATCH_SIZE = 1000
+
+
+class AnswerMatrix:
+    """Dense users x questions matrix with the choice index picked by each user.
+    Rows are sorted by user id, columns follow the order of the questions list."""
+
+    def __init__(self, user_ids, choices):
+        self.user_ids = user_ids
+        self.choices = choices
+
+    @staticmethod
+    def load(questions, vectors):
+        """Builds the matrix for the given AnswerVector queryset, reading one row
+        per user in a single query."""
+        rows = list(vectors.values_list('user_id', 'answers').order_by('user_id'))
+
+        question_count = len(questions)
+        user_ids = np.array([user_id for user_id, _ in rows], dtype=np.int64)
+        choices = np.zeros((len(rows), question_count), dtype=np.int64)
+        for i, (_, packed) in enumerate(rows):
+            packed = np.frombuffer(bytes(packed), dtype=np.uint16)[:question_count]
+            choices[i, :len(packed)] = packed
+
+        choices -= 1  # stored as choice + 1, so unanswered becomes UNANSWERED
+        return AnswerMatrix(user_ids, choices)
+
+    def with_row(self, user_id, packed):
+        """Returns a copy of the matrix where the row of user_id holds the given packed
+        AnswerVector answers, added if missing, or without that row if packed is None"""
+        row = self.row_of(user_id)
+        user_ids, choices = self.user_ids, self.choices
+        if row != -1:
+            user_ids, choices = np.delete(user_ids, row), np.delete(choices, row, axis=0)
+        if packed is None:
+            return AnswerMatrix(user_ids, choices)
+
+        values = unpack(packed, self.choices.shape[1])
+        at = np.searchsorted(user_ids, user_id)
+        return AnswerMatrix(np.insert(user_ids, at, user_id), np.insert(choices, at, values, axis=0))
+
+    def row_of(self, user_id):
+        """Returns the row index for the given user, or -1 if it isn't in the matrix"""
+        i = np.searchsorted(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return int(i)
+        return -1
+
+    def completed(self):
+        return (self.choices != UNANSWERED).all(axis=1)
+
+    def coincidences_against(self, row):
+        """Number of questions every user answered the same as the given row"""
+        return (self.choices == self.choices[row]).sum(axis=1)
+
+
+class SharedAnswerMatrix(AnswerMatrix):
+    """AnswerMatrix over the rows of the POLLS_SHARED_MATRIX file, all of them or the
+    given index array in user id order, without copying them. Scoring is split among
+    POLLS_MATCHING_PROCESSES processes for at least POLLS_PARALLEL_MIN_ROWS rows."""
+
+    def __init__(self, path, inode, array, rows=None):
+        self.path = path
+        self.inode = inode
+        self.array = array
+        self.rows = rows
+        self.user_ids = np.asarray(array[:, 0] if rows is None else array[rows, 0], dtype=np.int64)
+
+    @property
+    def choices(self):
+        """Copy of the rows"""
+        return np.asarray(self.array[:, 1:] if self.rows is None else self.array[self.rows, 1:], dtype=np.int64)
+
+    def completed(self):
+        # the file only has completed vectors, but a row removed since it was mapped is UNANSWERED
+        if self.array.shape[1] == 1:
+            return np.ones(len(self.user_ids), dtype=bool)
+        return np.asarray(self.array[:, 1] if self.rows is None else self.array[self.rows, 1]) != UNANSWERED
+
+    def coincidences_against(self, row):
+        values = self.array[row if self.rows is None else self.rows[row], 1:]
+        return sharedmatrix.coincidences(self.path, self.inode, self.array, self.rows, values,
+                                         getattr(settings, 'POLLS_MATCHING_PROCESSES', 0),
+                                         getattr(settings, 'POLLS_PARALLEL_MIN_ROWS', 50000)).astype(np.int64)
+
+
+def unpack(packed, question_count):
+    """Choice index picked for every question in the packed AnswerVector answers, or UNANSWERED"""
+    values = np.full(question_count, UNANSWERED, dtype=np.int64)
+    packed = np.frombuffer(bytes(packed), dtype=np.uint16)[:question_count]
+    values[:len(packed)] = packed.astype(np.int64) - 1
+    return values
+
+
+def percent(coincidences, question_count):
+    """Match percent shown to users, as the int of (coincidences / question count * 100)"""
+    return int(coincidences / question_count * 100.0)
+
+
+def candidate_vectors(user, gender_filter, among=None):
+    """Answer vectors of the users that can be matched with user, plus its own.
+    Those are the users that completed the poll and, with the gender filter on,
+    belong to the (gender, gender preference) bucket compatible with its
+    profile, so incompatible users are never loaded. With among, a queryset of
+    user ids including user, only those users are considered."""
+    vectors = AnswerVector.objects.filter(completed=True)
+    if among is not None:
+        vectors = vectors.filter(user_id__in=among)
+    if not gender_filter:
+        return vectors
+
+    own = vectors.filter(user=user)
+    try:
+        profile = user.profile
+    except Profile.DoesNotExist:
+        return own
+
+    bucket = Profile.objects.filter(gender=profile.gender_preference, gender_preference=profile.gender)
+    return vectors.filter(user_id__in=bucket.values('user_id')).union(own)
+
+
+def load_candidates(user, questions, gender_filter):
+    """Returns the candidate_vectors() queryset of user and its AnswerMatrix. With
+    POLLS_READ_DATABASE set the matrix is read from there, which may be behind, but
+    the row of user is always read from the default database so its latest answers
+    are used."""
+    vectors = candidate_vectors(user, gender_filter)
+    if shared_matrix_path(questions) is not None:
+        return vectors, _load_shared_candidates(user, questions, vectors, gender_filter)
+    with replica_reads():
+        matrix = AnswerMatrix.load(questions, vectors)
+    if read_database() is not None:
+        own = AnswerVector.objects.filter(user=user, completed=True).values_list('answers', flat=True).first()
+        matrix = matrix.with_row(user.id, own)
+    return vectors, matrix
+
+
+def shared_matrix_path(questions):
+    """Path of the POLLS_SHARED_MATRIX file for the given questions, or None if not set"""
+    prefix = getattr(settings, 'POLLS_SHARED_MATRIX', None)
+    if not prefix:
+        return None
+    key = hashlib.sha1(','.join(str(q.id) for q in questions).encode()).hexdigest()[:12]
+    return '%s-%s.npy' % (prefix, key)
+
+
+def discard_shared_matrix():
+    """Drops the POLLS_SHARED_MATRIX file after answers were written in bulk, it's built again on next use"""
+    prefix = getattr(settings, 'POLLS_SHARED_MATRIX', None)
+    if prefix:
+        sharedmatrix.discard(prefix)
+
+
+def update_shared_row(user_id, questions, packed):
+    """Stores the packed answers of a user that completed the poll in the shared matrix
+    file, or removes its row if packed is None"""
+    path = shared_matrix_path(questions)
+    if path is not None:
+        sharedmatrix.put_row(path, user_id, None if packed is None else unpack(packed, len(questions)))
+
+
+def _load_shared_candidates(user, questions, vectors, gender_filter):
+    """load_candidates() from the shared matrix file, built from the database on first
+    use. The row of user is refreshed from the default database first."""
+    path = shared_matrix_path(questions)
+
+    def build():
+        with replica_reads():
+            matrix = AnswerMatrix.load(questions, AnswerVector.objects.filter(completed=True))
+        return matrix.user_ids, matrix.choices
+
+    sharedmatrix.ensure(path, build)
+    own = AnswerVector.objects.filter(user=user, completed=True).values_list('answers', flat=True).first()
+    update_shared_row(user.id, questions, own)
+
+    inode, array, order = sharedmatrix.mapped(path)
+    if not gender_filter:
+        return SharedAnswerMatrix(path, inode, array, order)
+    with replica_reads():
+        ids = np.array(sorted(vectors.values_list('user_id', flat=True)), dtype=np.int64)
+    if own is not None and user.id not in ids:  # not in the replica yet
+        ids = np.union1d(ids, [user.id])
+    file_ids = array[:, 0] if order is None else array[order, 0]
+    rows = np.searchsorted(file_ids, ids)
+    found = rows < len(file_ids)
+    rows = rows[found][file_ids[rows[found]] == ids[found]]
+    return SharedAnswerMatrix(path, inode, array, rows if order is None else order[rows])
+
+
+def top_k(scores, eligible, k):
+    """Returns the rows of the k best eligible scores, best first. Ties are broken
+    by lowest row (thus lowest user id), so the result is deterministic."""
+    candidates = np.flatnonzero(eligible)
+    if k <= 0 or len(candidates) == 0:
+        return candidates[:0]
+
+    # single int key per candidate: higher score first, then lower row
+    n = len(scores)
+    keys = scores[candidates] * n + (n - 1 - candidates)
+    if k < len(candidates):
+        best = np.argpartition(-keys, k - 1)[:k]
+    else:
+        best = np.arange(len(candidates))
+    best = best[np.argsort(-keys[best])]
+    return candidates[best]
+
+
+def matching_mode():
+    return getattr(settings, 'POLLS_MATCHING_MODE', 'exact')
+
+
+def lsh_bands():
+    """LSH bands of the 'approximate' matching mode, 0 when matching is exact"""
+    if matching_mode() != 'approximate':
+        return 0
+    return getattr(settings, 'POLLS_LSH_BANDS', 0)
+
+
+def lsh_keys(choices, questions):
+    """LSH keys of every row of the choices matrix, with the POLLS_LSH_* settings"""
+    return band_keys(choices, [q.id for q in questions], lsh_bands(), getattr(settings, 'POLLS_LSH_BAND_SIZE', 4))
+
+
+def index_lsh(user_id, questions, packed):
+    """Stores the LSH keys of the packed answers of a user that completed the poll, or
+    removes them if packed is None. Returns the keys."""
+    if packed is None:
+        LshBucket.objects.filter(user_id=user_id).delete()
+        return None
+    keys = lsh_keys(unpack(packed, len(questions))[np.newaxis], questions)[0].tolist()
+    if dict(LshBucket.objects.filter(user_id=user_id).values_list('band', 'key')) != dict(enumerate(keys)):
+        with transaction.atomic():
+            LshBucket.objects.filter(user_id=user_id).delete()
+            LshBucket.objects.bulk_create([LshBucket(user_id=user_id, band=band, key=key)
+                                           for band, key in enumerate(keys)])
+    return keys
+
+
+def rebuild_lsh_index(questions):
+    """Stores the LSH keys of every user that completed the poll. Needed after turning
+    the 'approximate' mode on, changing its bands, or changing the questions. Returns
+    how many users were indexed."""
+    count = 0
+    with transaction.atomic():
+        LshBucket.objects.all().delete()
+        if not lsh_bands() or not questions:
+            return count
+        vectors = AnswerVector.objects.filter(completed=True).order_by('user_id').values_list('user_id', 'answers')
+        last = 0
+        while True:
+            rows = list(vectors.filter(user_id__gt=last)[:LSH_BATCH_SIZE])
+            if not rows:
+                return count
+            keys = lsh_keys(np.array([unpack(answers, len(questions)) for _, answers in rows]), questions)
+            LshBucket.objects.bulk_create([LshBucket(user_id=user_id, band=band, key=key)
+                                           for (user_id, _), row in zip(rows, keys.tolist())
+                                           for band, key in enumerate(row)], batch_size=LSH_BATCH_SIZE)
+            count += len(rows)
+            last = rows[-1][0]
+
+
+def load_lsh_candidates(user, questions, gender_filter):
+    """AnswerMatrix of user and of the candidate_vectors() sharing an LSH key with it,
+    found through the LshBucket index. The keys of user are refreshed first."""
+    own = AnswerVector.objects.filter(user=user, completed=True).values_list('answers', flat=True).first()
+    keys = index_lsh(user.id, questions, own)
+    if keys is None:
+        return AnswerMatrix(np.zeros(0, dtype=np.int64), np.zeros((0, len(questions)), dtype=np.int64))
+
+    lookup = Q()
+    for band, key in enumerate(keys):
+        lookup |= Q(band=band, key=key)
+    sharing = LshBucket.objects.filter(lookup).values('user_id')
+    with replica_reads():
+        matrix = AnswerMatrix.load(questions, candidate_vectors(user, gender_filter, among=sharing))
+    return matrix.with_row(user.id, own)
+
+
+def _eligible_candidates(matrix, me):
+    eligible = matrix.completed()
+    eligible[me] = False  # will always match 100% myself
+    return eligible
+
+
+def score_candidates(matrix, me):
+    """Returns the coincidences of every row against me and the rows that may enter its own Match list"""
+    return matrix.coincidences_against(me), _eligible_candidates(matrix, me)
+
+
+def _lock_lists(user_ids):
+    """Locks the answer vectors of the given users until the end of the transaction, which
+    serializes every change to their Match lists. Taken in user id order, so two workers
+    never wait for each other. SQLite has no row locks, but it only runs one write
+    transaction at a time."""
+    list(AnswerVector.objects.select_for_update().filter(user_id__in=user_ids).order_by('user_id')
+         .values_list('pk', flat=True))
+
+
+def _save_list(user_id, coincidences, candidates, limit):
+    """Replaces the Match list of user_id with the given candidate rows, best first"""
+    Match.objects.filter(user_id=user_id).delete()
+    Match.objects.bulk_create([Match(user_id=user_id, candidate_id=candidate, coincidences=c)
+                               for candidate, c in zip(candidates, coincidences)], ignore_conflicts=True)
+    floor = int(coincidences[-1]) if 0 < limit <= len(candidates) else -1
+    AnswerVector.objects.filter(user_id=user_id).update(matches_stale=False, match_floor=floor,
+                                                        matches_version=F('matches_version') + 1)
+
+
+@retry_if_locked
+def refresh_matches(user, questions, limit, gender_filter=False):
+    """Recomputes the whole Match list of user against every user that completed the
+    poll, or only against those sharing an LSH key with it in the 'approximate' mode"""
+    if lsh_bands():
+        matrix = load_lsh_candidates(user, questions, gender_filter)
+    else:
+        _, matrix = load_candidates(user, questions, gender_filter)
+    me = matrix.row_of(user.id)
+    if me == -1:
+        return
+
+    coincidences, eligible = score_candidates(matrix, me)
+    best = top_k(coincidences, eligible, limit)
+    with transaction.atomic():
+        _lock_lists([user.id])
+        _save_list(user.id, coincidences[best].tolist(), matrix.user_ids[best].tolist(), limit)
+
+
+@retry_if_locked
+def update_matches(user, questions, limit, gender_filter=False):
+    """Called after the answers or the profile of user changed. Recomputes its own
+    Match list and applies the coincidence deltas to the lists of everyone else.
+
+    Lists of other users are patched in place: existing entries move by the
+    delta, and user enters the lists where it now beats the last entry. When
+    user drops below the last entry of a full list (or leaves it) someone else
+    may now deserve the spot, so that list is flagged as stale and gets rebuilt
+    once its owner visits the index again.
+
+    Patching needs the exact coincidences against everyone, so the own list is
+    exact too, even in the 'approximate' mode, which only keeps the LSH keys of
+    user up to date here."""
+    if lsh_bands():
+        packed = AnswerVector.objects.filter(user=user, completed=True).values_list('answers', flat=True).first()
+        index_lsh(user.id, questions, packed)
+    vectors, matrix = load_candidates(user, questions, gender_filter)
+    me = matrix.row_of(user.id)
+    if me == -1:  # not a candidate anymore
+        with transaction.atomic():
+            holders = list(Match.objects.filter(candidate=user).values_list('user_id', flat=True))
+            _lock_lists(holders + [user.id])
+            Match.objects.filter(user=user).delete()
+            AnswerVector.objects.filter(user_id__in=holders).exclude(match_floor=-1).update(matches_stale=True)
+            Match.objects.filter(candidate=user).delete()
+            AnswerVector.objects.filter(user_id__in=holders + [user.id]) \
+                .update(matches_version=F('matches_version') + 1)
+        return
+
+    ids = matrix.user_ids
+    coincidences, eligible = score_candidates(matrix, me)
+    best = top_k(coincidences, eligible, limit)
+
+    with transaction.atomic():
+        # the scores are symmetric, so coincidences[i] is also the score of user in the list of ids[i]
+        stored = np.full(len(ids), -1, dtype=np.int64)
+        outside = []  # lists holding user that aren't compatible with it anymore
+        for user_id, c in Match.objects.filter(candidate=user).values_list('user_id', 'coincidences'):
+            row = matrix.row_of(user_id)
+            if row != -1:
+                stored[row] = c
+            else:
+                outside.append(user_id)
+        floor = np.full(len(ids), -1, dtype=np.int64)
+        for user_id, f in vectors.values_list('user_id', 'match_floor'):
+            row = matrix.row_of(user_id)
+            if row != -1:
+                floor[row] = f
+
+        in_list = stored != -1
+        full = floor != -1
+        entering = ~in_list & eligible & (~full | (coincidences > floor)) & (limit > 0)
+        stale = in_list & full & (coincidences < floor)
+        changed = ids[in_list | entering].tolist()
+        _lock_lists(changed + outside + [user.id])
+
+        _save_list(user.id, coincidences[best].tolist(), ids[best].tolist(), limit)
+        Match.objects.filter(candidate=user, user_id__in=outside).delete()
+        AnswerVector.objects.filter(user_id__in=outside).exclude(match_floor=-1).update(matches_stale=True)
+        delta = coincidences - stored
+        for d in np.unique(delta[in_list & (delta != 0)]):
+            rows = in_list & (delta == d)
+            Match.objects.filter(candidate=user, user_id__in=ids[rows].tolist()) \
+                .update(coincidences=F('coincidences') + int(d))
+        # the list may have gotten user from its own refresh meanwhile
+        Match.objects.bulk_create([Match(user_id=int(ids[i]), candidate=user, coincidences=int(coincidences[i]))
+                                   for i in np.flatnonzero(entering)], ignore_conflicts=True)
+
+        # lists that user entered keep their best `limit` entries, whoever else entered them meanwhile
+        entries = {}
+        for pk, user_id, candidate_id, c in Match.objects.filter(user_id__in=ids[entering].tolist()) \
+                .values_list('pk', 'user_id', 'candidate_id', 'coincidences'):
+            entries.setdefault(user_id, []).append((-c, candidate_id, pk))
+        Match.objects.filter(pk__in=[pk for entry in entries.values()
+                                     for _, _, pk in sorted(entry)[limit:]]).delete()
+
+        # refresh the floor of every list that changed
+        floors = {user_id: -1 for user_id in changed}
+        lists = Match.objects.filter(user_id__in=changed).values('user_id') \
+            .annotate(size=Count('pk'), last=Min('coincidences'))
+        for entry in lists:
+            if entry['size'] >= limit:
+                floors[entry['user_id']] = entry['last']
+        for f in set(floors.values()):
+            AnswerVector.objects.filter(user_id__in=[u for u, v in floors.items() if v == f]).update(match_floor=f)
+        AnswerVector.objects.filter(user_id__in=ids[stale].tolist()).update(matches_stale=True)
+        patched = ids[(in_list & (delta != 0)) | entering].tolist() + outside
+        AnswerVector.objects.filter(user_id__in=patched).update(matches_version=F('matches_version') + 1)
+
+
+def get_matches(user, question_count, limit):
+    """Returns the best `limit` matches for user as a list of {'user', 'score'},
+    best first, from its stored Match list."""
+    if question_count == 0:
+        return []
+
+    matches = Match.objects.filter(user=user).select_related('candidate') \
+        .order_by('-coincidences', 'candidate_id')[:max(limit, 0)]
+    return [{'user': m.candidate, 'score': percent(m.coincidences, question_count)} for m in matches]
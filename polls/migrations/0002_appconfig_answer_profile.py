@@ -0,0 +1,61 @@
+# Generated by Django 3.1.6 on 2026-10-18 06:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppConfig',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frase_mejores_candidatos', models.CharField(default='mejores candidatos:', help_text='Frase mostrada cuando se muestran los mejores candidatos', max_length=1024)),
+                ('frase_inicial', models.CharField(default='completa la encuesta', help_text='Frase mostrada a las personas que todavia no completaron cuestionario', max_length=1024)),
+                ('frase_elegir_genero', models.CharField(blank=True, default='completa los datos', max_length=1024)),
+                ('afinidad_cantidad_gente', models.IntegerField(default=3, help_text='Cantidad de gente mostrada en afinidad')),
+                ('color_principal', models.CharField(default='#ff0000', help_text='Color de la barra', max_length=10)),
+                ('color_fondo', models.CharField(default='#ffffff', max_length=10)),
+                ('frase_logo', models.CharField(default='coincido.com.ar', help_text='Frase al lado del logo', max_length=1024)),
+                ('imagen_logo', models.ImageField(help_text='Imagen del logo', upload_to='')),
+                ('imagen_fondo', models.ImageField(help_text='Imagen del fondo de la página', upload_to='')),
+                ('imagen_principal', models.ImageField(default='', help_text='Imagen principal, mostrada en login, registro y menu', upload_to='')),
+                ('pedir_genero', models.BooleanField(default=True, help_text='Solo matchear gente del género que buscan')),
+                ('pedir_email', models.BooleanField(default=True, help_text='Pedir email en el registro')),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='choice',
+            name='votes',
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='choice_image',
+            field=models.ImageField(blank=True, null=True, upload_to=''),
+        ),
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gender', models.CharField(choices=[('M', 'Hombre'), ('F', 'Mujer')], default='M', max_length=1)),
+                ('gender_preference', models.CharField(choices=[('M', 'Hombre'), ('F', 'Mujer')], default='F', max_length=1)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Answer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('choice', models.IntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='polls.question')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.1.6 on 2026-10-18 06:53
+
+from array import array
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_answer_vectors(apps, schema_editor):
+    Question = apps.get_model('polls', 'Question')
+    Answer = apps.get_model('polls', 'Answer')
+    AnswerVector = apps.get_model('polls', 'AnswerVector')
+
+    positions = {pk: i for i, pk in enumerate(Question.objects.values_list('id', flat=True))}
+    packed = {}
+    for user_id, question_id, choice in Answer.objects.values_list('user_id', 'question_id', 'choice'):
+        vector = packed.setdefault(user_id, array('H', [0] * len(positions)))
+        if question_id in positions and 0 <= choice < 0xffff:
+            vector[positions[question_id]] = choice + 1
+
+    AnswerVector.objects.bulk_create([
+        AnswerVector(user_id=user_id, answers=vector.tobytes(), completed=len(vector) > 0 and 0 not in vector)
+        for user_id, vector in packed.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0002_appconfig_answer_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerVector',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('answers', models.BinaryField(default=b'')),
+                ('completed', models.BooleanField(db_index=True, default=False)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='answer_vector', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(build_answer_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.6 on 2026-10-18 06:57
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0003_answervector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answervector',
+            name='match_floor',
+            field=models.IntegerField(default=-1),
+        ),
+        migrations.AddField(
+            model_name='answervector',
+            name='matches_stale',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='Match',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coincidences', models.IntegerField()),
+                ('candidate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['user', '-coincidences'], name='polls_match_user_id_0f4cf4_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='match',
+            unique_together={('user', 'candidate')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0005_matchjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='profile',
+            index=models.Index(fields=['gender', 'gender_preference'], name='polls_profi_gender_867382_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0006_profile_gender_bucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimingBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=200)),
+                ('metric', models.CharField(max_length=20)),
+                ('upper_bound', models.FloatField()),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('endpoint', 'metric', 'upper_bound')},
+            },
+        ),
+    ]
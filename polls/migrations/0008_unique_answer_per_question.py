@@ -0,0 +1,29 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:16
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_answers(apps, schema_editor):
+    """Keeps only the latest answer of every user to each question"""
+    Answer = apps.get_model('polls', 'Answer')
+    duplicated = Answer.objects.values('user_id', 'question_id') \
+        .annotate(latest=Max('id'), rows=Count('id')).filter(rows__gt=1)
+    for entry in duplicated:
+        Answer.objects.filter(user_id=entry['user_id'], question_id=entry['question_id']) \
+            .exclude(id=entry['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_timingbucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_answers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='answer',
+            constraint=models.UniqueConstraint(fields=('user', 'question'), name='unique_answer_per_question'),
+        ),
+    ]
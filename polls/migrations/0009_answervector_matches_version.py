@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0008_unique_answer_per_question'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answervector',
+            name='matches_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
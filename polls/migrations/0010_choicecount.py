@@ -0,0 +1,36 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:22
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def count_answers(apps, schema_editor):
+    Answer = apps.get_model('polls', 'Answer')
+    ChoiceCount = apps.get_model('polls', 'ChoiceCount')
+    counts = Answer.objects.values('question_id', 'choice').annotate(votes=Count('id')).order_by()
+    ChoiceCount.objects.bulk_create([ChoiceCount(question_id=c['question_id'], choice=c['choice'], votes=c['votes'])
+                                     for c in counts], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0009_answervector_matches_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChoiceCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('choice', models.IntegerField()),
+                ('votes', models.BigIntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='polls.question')),
+            ],
+            options={
+                'unique_together': {('question', 'choice')},
+            },
+        ),
+        migrations.RunPython(count_answers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0010_choicecount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appconfig',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='choice',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0011_image_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answer',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.6 on 2026-10-18 07:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0012_answer_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LshBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.PositiveSmallIntegerField()),
+                ('key', models.BigIntegerField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='lshbucket',
+            index=models.Index(fields=['band', 'key'], name='polls_lshbu_band_9cdcbb_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lshbucket',
+            unique_together={('user', 'band')},
+        ),
+    ]
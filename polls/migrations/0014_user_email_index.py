@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db import migrations, models
+
+# the email of users is searched in the user and answer admin
+EMAIL_INDEX = models.Index(fields=['email'], name='polls_user_email_idx')
+
+
+def add_email_index(apps, schema_editor):
+    schema_editor.add_index(apps.get_model(settings.AUTH_USER_MODEL), EMAIL_INDEX)
+
+
+def remove_email_index(apps, schema_editor):
+    schema_editor.remove_index(apps.get_model(settings.AUTH_USER_MODEL), EMAIL_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0013_lshbucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_email_index, remove_email_index),
+    ]
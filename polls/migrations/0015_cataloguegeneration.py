@@ -0,0 +1,20 @@
+# Generated by Django 3.1.6 on 2026-10-18 08:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0014_user_email_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogueGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
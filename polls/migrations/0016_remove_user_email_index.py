@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db import migrations, models
+
+# added by 0014 outside of the migration state, where no later auth migration would keep it
+EMAIL_INDEX = models.Index(fields=['email'], name='polls_user_email_idx')
+
+
+def remove_email_index(apps, schema_editor):
+    schema_editor.remove_index(apps.get_model(settings.AUTH_USER_MODEL), EMAIL_INDEX)
+
+
+def add_email_index(apps, schema_editor):
+    schema_editor.add_index(apps.get_model(settings.AUTH_USER_MODEL), EMAIL_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('polls', '0015_cataloguegeneration'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_email_index, add_email_index),
+    ]
@@ -1,6 +1,10 @@
 import datetime
+import time
+from array import array
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, models, router, transaction
 from django.db.models import CASCADE
 from django.utils import timezone
 from django.contrib.auth.models import User
@@ -17,6 +21,9 @@ class Question(models.Model):
         return self.pub_date >= timezone.now() - datetime.timedelta(days=1)
 
 
+_MISSING = object()
+
+
 class AppConfig(models.Model):
     frase_mejores_candidatos = models.CharField(default="mejores candidatos:", max_length=1024,
                                                 help_text="Frase mostrada cuando se muestran los mejores candidatos")
@@ -44,25 +51,169 @@ class AppConfig(models.Model):
 
     pedir_email = models.BooleanField(help_text="Pedir email en el registro", default=True)
 
+    # WebP copies of the images in several widths, see polls.images
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+
+    CACHE_KEY = 'polls:appconfig'
+
+    # process local copy as (config, monotonic expiry time)
+    _memo = None
+
     @staticmethod
     def get():
+        """Returns the site configuration. It's memoized in the process for
+        POLLS_CONFIG_TIMEOUT seconds and, if POLLS_CONFIG_CACHE names a cache
+        alias, shared between processes through it. Saving or deleting an
+        AppConfig clears both."""
+        memo = AppConfig._memo
+        now = time.monotonic()
+        if memo is not None and now < memo[1]:
+            return memo[0]
+
+        shared = AppConfig._shared_cache()
+        config = shared.get(AppConfig.CACHE_KEY, _MISSING) if shared is not None else _MISSING
+        if config is _MISSING:
+            config = AppConfig._load()
+            if shared is not None:
+                shared.set(AppConfig.CACHE_KEY, config)
+
+        AppConfig._memo = (config, now + getattr(settings, 'POLLS_CONFIG_TIMEOUT', 60))
+        return config
+
+    @staticmethod
+    def _load():
         try:
             return AppConfig.objects.first()
         except:
             config = AppConfig.objects.create()
             return config
 
+    @staticmethod
+    def _shared_cache():
+        alias = getattr(settings, 'POLLS_CONFIG_CACHE', None)
+        return caches[alias] if alias else None
+
+    @staticmethod
+    def clear_cache():
+        AppConfig._memo = None
+        shared = AppConfig._shared_cache()
+        if shared is not None:
+            shared.delete(AppConfig.CACHE_KEY)
+
 
 class Choice(models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice_text = models.CharField(max_length=200)
     choice_image = models.ImageField(null=True, blank=True)
+    renditions = models.JSONField(default=dict, blank=True, editable=False)  # see polls.images
+
+
+class CatalogueGeneration(models.Model):
+    """Single row bumped whenever a Question or Choice changes, so every process
+    notices that its copy of the question catalogue is outdated"""
+    generation = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def current():
+        return CatalogueGeneration.objects.filter(pk=1).values_list('generation', flat=True).first() or 0
+
+    @staticmethod
+    def bump():
+        if not CatalogueGeneration.objects.filter(pk=1).update(generation=models.F('generation') + 1):
+            CatalogueGeneration.objects.get_or_create(pk=1, defaults={'generation': 1})
 
 
 class Answer(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     choice = models.IntegerField(default=0)  # choice picked in the answer
+    updated_at = models.DateTimeField(auto_now=True)  # part of the ETag of the question page
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'question'], name='unique_answer_per_question')]
+
+    # rows per statement, keeps the parameter count under SQLite's limit
+    UPSERT_BATCH_SIZE = 300
+
+    @staticmethod
+    def upsert(user, choices):
+        """Saves the choice picked by user for every question id in the `choices` dict,
+        in one transaction, safe under concurrent votes: an UPDATE that locks the existing
+        answers, a SELECT of their previous choices, then INSERT ... ON CONFLICT statements
+        for the ChoiceCount deltas and for the answers, one per batch of UPSERT_BATCH_SIZE rows."""
+        connection = connections[router.db_for_write(Answer)]
+        qn = connection.ops.quote_name
+        items = list(choices.items())
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            # writing before reading locks the rows, and makes SQLite take its write lock
+            # now, waiting for other writers, instead of failing when a read must turn into a write
+            existing = Answer.objects.using(connection.alias).filter(user=user, question_id__in=choices)
+            existing.update(choice=models.F('choice'))
+            previous = dict(existing.values_list('question_id', 'choice'))
+            deltas = {}
+            for question_id, choice in items:
+                if previous.get(question_id) != choice:
+                    if question_id in previous:
+                        deltas[(question_id, previous[question_id])] = \
+                            deltas.get((question_id, previous[question_id]), 0) - 1
+                    deltas[(question_id, choice)] = deltas.get((question_id, choice), 0) + 1
+            ChoiceCount.add(deltas, using=connection.alias)
+
+            now = connection.ops.adapt_datetimefield_value(timezone.now())
+            for start in range(0, len(items), Answer.UPSERT_BATCH_SIZE):
+                batch = items[start:start + Answer.UPSERT_BATCH_SIZE]
+                cursor.execute(
+                    "INSERT INTO %s (%s, %s, %s, %s) VALUES %s ON CONFLICT (%s, %s) "
+                    "DO UPDATE SET %s = excluded.%s, %s = excluded.%s" % (
+                        qn(Answer._meta.db_table), qn('user_id'), qn('question_id'), qn('choice'), qn('updated_at'),
+                        ', '.join(['(%s, %s, %s, %s)'] * len(batch)), qn('user_id'), qn('question_id'),
+                        qn('choice'), qn('choice'), qn('updated_at'), qn('updated_at')),
+                    [value for question_id, choice in batch for value in (user.id, question_id, choice, now)])
+
+
+class ChoiceCount(models.Model):
+    """How many users picked each choice, kept up to date as answers change so the
+    results don't need to count the Answer table. `manage.py reconcilecounts` fixes
+    any drift."""
+
+    question = models.ForeignKey(Question, on_delete=models.CASCADE)
+    choice = models.IntegerField()  # choice index, as in Answer.choice
+    votes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('question', 'choice')]
+
+    @staticmethod
+    def reconcile():
+        """Recounts the votes from the Answer table and fixes the counters that differ.
+        Returns how many were fixed."""
+        with transaction.atomic():
+            actual = {(c['question_id'], c['choice']): c['votes'] for c in
+                      Answer.objects.values('question_id', 'choice').annotate(votes=models.Count('id')).order_by()}
+            stored = {(question_id, choice): votes for question_id, choice, votes in
+                      ChoiceCount.objects.values_list('question_id', 'choice', 'votes')}
+            deltas = {key: actual.get(key, 0) - stored.get(key, 0) for key in set(actual) | set(stored)}
+            ChoiceCount.add(deltas)
+            ChoiceCount.objects.filter(votes=0).delete()
+        return sum(1 for d in deltas.values() if d != 0)
+
+    @staticmethod
+    def add(deltas, using=None):
+        """Adds to the counters the vote deltas given as a dict (question id, choice) -> delta"""
+        deltas = [(key, d) for key, d in deltas.items() if d != 0]
+        if not deltas:
+            return
+        connection = connections[using or router.db_for_write(ChoiceCount)]
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for start in range(0, len(deltas), Answer.UPSERT_BATCH_SIZE):
+                batch = deltas[start:start + Answer.UPSERT_BATCH_SIZE]
+                cursor.execute(
+                    "INSERT INTO %s (%s, %s, %s) VALUES %s ON CONFLICT (%s, %s) DO UPDATE SET %s = %s.%s + excluded.%s" % (
+                        qn(ChoiceCount._meta.db_table), qn('question_id'), qn('choice'), qn('votes'),
+                        ', '.join(['(%s, %s, %s)'] * len(batch)), qn('question_id'), qn('choice'),
+                        qn('votes'), qn(ChoiceCount._meta.db_table), qn('votes'), qn('votes')),
+                    [value for (question_id, choice), d in batch for value in (question_id, choice, d)])
 
 
 class Profile(models.Model):
@@ -74,3 +225,157 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES, default='M',)
     gender_preference = models.CharField(max_length=1, choices=GENDER_CHOICES, default='F',)
+
+    class Meta:
+        # candidates are looked up by (gender, gender_preference) bucket when matching
+        indexes = [models.Index(fields=['gender', 'gender_preference'])]
+
+
+class AnswerVector(models.Model):
+    """Denormalized copy of the user's answers, so they can be read in a single row.
+    Holds one unsigned short per question position with the picked choice + 1, or 0
+    when the question wasn't answered yet."""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='answer_vector')
+    answers = models.BinaryField(default=b'')
+    completed = models.BooleanField(default=False, db_index=True)
+
+    # state of the user's Match list: whether it needs a full recompute, and the
+    # coincidences of its last entry, or -1 while it has room for more candidates
+    matches_stale = models.BooleanField(default=True)
+    match_floor = models.IntegerField(default=-1)
+    # bumped every time the Match list changes, keys the cached rendering of the list
+    matches_version = models.IntegerField(default=0)
+
+    def choices(self, question_count):
+        """Returns the choice picked for every question position, or -1 if unanswered"""
+        packed = array('H', bytes(self.answers))[:question_count]
+        return [c - 1 for c in packed] + [-1] * (question_count - len(packed))
+
+    def set_choices(self, choices):
+        packed = array('H', [c + 1 if 0 <= c < 0xffff else 0 for c in choices])
+        self.answers = packed.tobytes()
+        self.completed = len(packed) > 0 and 0 not in packed
+
+    def set_choice(self, position, choice, question_count):
+        choices = self.choices(question_count)
+        choices[position] = choice
+        self.set_choices(choices)
+
+    @staticmethod
+    def refresh(user, questions):
+        """Rebuilds the vector of user from its Answer rows"""
+        positions = {q.id: i for i, q in enumerate(questions)}
+        choices = [-1] * len(questions)
+        for question_id, choice in Answer.objects.filter(user=user).values_list('question_id', 'choice'):
+            if question_id in positions:
+                choices[positions[question_id]] = choice
+
+        vector, _ = AnswerVector.objects.get_or_create(user=user)
+        vector.set_choices(choices)
+        vector.save(update_fields=['answers', 'completed'])
+        return vector
+
+    # vectors written per statement by refresh_all()
+    REFRESH_BATCH_SIZE = 1000
+
+    @staticmethod
+    def refresh_all(questions):
+        """Rebuilds the vector of every user from a single scan of the Answer table, after
+        questions were added or removed, and flags every Match list as stale"""
+        positions = {q.id: i for i, q in enumerate(questions)}
+        packed = {}
+        for user_id, question_id, choice in Answer.objects.values_list('user_id', 'question_id', 'choice') \
+                .iterator(chunk_size=AnswerVector.REFRESH_BATCH_SIZE):
+            vector = packed.setdefault(user_id, array('H', [0] * len(questions)))
+            if question_id in positions and 0 <= choice < 0xffff:
+                vector[positions[question_id]] = choice + 1
+        empty = array('H', [0] * len(questions))
+
+        with transaction.atomic():
+            last = 0
+            while True:
+                batch = list(AnswerVector.objects.filter(id__gt=last).order_by('id')
+                             .only('id', 'user_id')[:AnswerVector.REFRESH_BATCH_SIZE])
+                if not batch:
+                    break
+                for vector in batch:
+                    answers = packed.pop(vector.user_id, empty)
+                    vector.answers = answers.tobytes()
+                    vector.completed = len(answers) > 0 and 0 not in answers
+                    vector.matches_stale = True
+                AnswerVector.objects.bulk_update(batch, ['answers', 'completed', 'matches_stale'])
+                last = batch[-1].id
+
+            AnswerVector.objects.bulk_create([
+                AnswerVector(user_id=user_id, answers=answers.tobytes(), completed=len(answers) > 0 and 0 not in answers)
+                for user_id, answers in packed.items()
+            ], batch_size=AnswerVector.REFRESH_BATCH_SIZE)
+
+
+class Match(models.Model):
+    """One of the best candidates of a user, kept up to date by polls.matching"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matches')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    coincidences = models.IntegerField()  # questions both users answered the same way
+
+    class Meta:
+        unique_together = [('user', 'candidate')]
+        indexes = [models.Index(fields=['user', '-coincidences'])]
+
+
+class LshBucket(models.Model):
+    """LSH key of one band of the answers of a user that completed the poll, see
+    polls.approximate. Only kept in the 'approximate' matching mode."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    band = models.PositiveSmallIntegerField()
+    key = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [('user', 'band')]
+        indexes = [models.Index(fields=['band', 'key'])]
+
+
+class MatchJob(models.Model):
+    """Pending recompute of the matches of a user, run by the runmatchworker command"""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='+')
+    update_others = models.BooleanField(default=False)  # also patch the lists of other users
+    requested_at = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)  # set while a worker runs it
+
+
+class TimingBucket(models.Model):
+    """Histogram bucket of a request metric, filled by polls.instrumentation"""
+
+    endpoint = models.CharField(max_length=200)
+    metric = models.CharField(max_length=20)
+    upper_bound = models.FloatField()
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('endpoint', 'metric', 'upper_bound')]
+
+    # rows per statement, keeps the parameter count under SQLite's limit
+    UPSERT_BATCH_SIZE = 200
+
+    @staticmethod
+    def add(counts, using=None):
+        """Adds to the buckets the counts given as a dict (endpoint, metric, upper bound) -> count,
+        creating the missing ones, with one INSERT ... ON CONFLICT statement per batch"""
+        counts = list(counts.items())
+        connection = connections[using or router.db_for_write(TimingBucket)]
+        qn = connection.ops.quote_name
+        table = qn(TimingBucket._meta.db_table)
+        with connection.cursor() as cursor:
+            for start in range(0, len(counts), TimingBucket.UPSERT_BATCH_SIZE):
+                batch = counts[start:start + TimingBucket.UPSERT_BATCH_SIZE]
+                cursor.execute(
+                    "INSERT INTO %s (%s, %s, %s, %s) VALUES %s ON CONFLICT (%s, %s, %s) "
+                    "DO UPDATE SET %s = %s.%s + excluded.%s" % (
+                        table, qn('endpoint'), qn('metric'), qn('upper_bound'), qn('count'),
+                        ', '.join(['(%s, %s, %s, %s)'] * len(batch)), qn('endpoint'), qn('metric'),
+                        qn('upper_bound'), qn('count'), table, qn('count'), qn('count')),
+                    [value for key, count in batch for value in key + (count,)])
@@ -0,0 +1,45 @@
+import contextlib
+import contextvars
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_replica_reads = contextvars.ContextVar('polls_replica_reads', default=False)
+
+
+def read_database():
+    """Alias of the read-only database for heavy reads, or None to use the default one"""
+    return getattr(settings, 'POLLS_READ_DATABASE', None)
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """Sends the reads made in the block to POLLS_READ_DATABASE, if set. Only for
+    reads that may lag a bit behind the default database, like the answers of the
+    other users when matching or the exports."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class ReadReplicaRouter:
+    """Reads from POLLS_READ_DATABASE inside replica_reads() blocks, everything else
+    goes to the default database. The replica is never written nor migrated."""
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return read_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == read_database():
+            return False
+        return None
@@ -0,0 +1,270 @@
+"""Answer matrix kept in a memory-mapped file shared by every process of the site,
+see POLLS_SHARED_MATRIX. The file is a .npy array with one int32 row per user that
+completed the poll: the user id followed by the choice index picked for every
+question. Mapped read-only, its pages are in memory only once for all the
+processes, and a pool of processes can score the rows of large matrices in
+parallel without copying them.
+
+The file is written with spare rows, and its first rows hold three counters: how
+many rows are sorted by user id, how many are used and how many were removed.
+Changes are serialized with a lock file and made in place: a changed row is
+overwritten, a removed one gets every choice set to REMOVED, and a new one is
+appended after the used rows, unsorted. Once COMPACT_AFTER rows were appended
+or removed, a background thread writes a new sorted file without the removed
+rows that replaces the old one, which the processes still reading it keep
+mapped until they are done. Only when the spare rows run out does the writer
+compact the file itself.
+
+Only numpy is imported here, so the pool processes start without loading Django."""
+import atexit
+import concurrent.futures
+import contextlib
+import fcntl
+import glob
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+DTYPE = np.int32
+
+# choice of every question in a removed row, like matching.UNANSWERED
+REMOVED = -1
+
+# spare rows of a new file, at least, or an eighth of its rows
+SPARE_ROWS = 1024
+
+# appended or removed rows that trigger a compaction of the file
+COMPACT_AFTER = 256
+
+
+class StaleMatrix(Exception):
+    """The file was replaced while a pool process was about to read it"""
+
+
+def _map(path, mode='r'):
+    """Returns (inode, array) for the whole file at path, mapped with the given mode"""
+    with open(path, 'rb' if mode == 'r' else 'r+b') as f:
+        np.lib.format.read_magic(f)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        inode = os.fstat(f.fileno()).st_ino
+        return inode, np.memmap(f, dtype=dtype, mode=mode, offset=f.tell(), shape=shape)
+
+
+def _header_rows(width):
+    return -(-3 // width)  # enough for the three counters
+
+
+def _counters(array):
+    """The (sorted, used, removed) row counters of the mapping of a whole file, writable if it is"""
+    return array[:_header_rows(array.shape[1])].reshape(-1)[:3]
+
+
+def _rows(array):
+    """The used rows of the mapping of a whole file"""
+    start = _header_rows(array.shape[1])
+    return array[start:start + int(_counters(array)[1])]
+
+
+def _removed(row):
+    return len(row) > 1 and row[1] == REMOVED
+
+
+# path -> (inode, array) mapped by this process
+_mapped = {}
+
+
+def _current(path):
+    cached = _mapped.get(path)
+    if cached is None or cached[0] != os.stat(path).st_ino:
+        cached = _mapped[path] = _map(path)
+    return cached
+
+
+def mapped(path):
+    """Returns (inode, rows, order) for the current file at path, mapped once per
+    process and again after it's replaced. rows are the used rows, and order is
+    None if they are all sorted by user id and none was removed, or else the index
+    array of the rows not removed in user id order. Raises FileNotFoundError if
+    there is no file."""
+    inode, array = _current(path)
+    sorted_count, used, removed = (int(c) for c in _counters(array))
+    rows = _rows(array)
+    if sorted_count == used and not removed:
+        return inode, rows, None
+    order = np.argsort(rows[:, 0], kind='stable')  # a sorted run and a short tail
+    if removed and rows.shape[1] > 1:
+        order = order[rows[order, 1] != REMOVED]
+    return inode, rows, order
+
+
+def write(path, user_ids, choices):
+    """Replaces the file at path with the given rows, sorted by user id, and spare ones"""
+    order = np.argsort(user_ids, kind='stable')
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    count, width = len(user_ids), choices.shape[1] + 1
+    start = _header_rows(width)
+    shape = (start + count + max(SPARE_ROWS, count // 8), width)
+    out = np.lib.format.open_memmap(tmp, mode='w+', dtype=DTYPE, shape=shape, version=(1, 0))
+    out[start:start + count, 0] = np.asarray(user_ids)[order]
+    out[start:start + count, 1:] = choices[order]
+    _counters(out)[:] = (count, count, 0)
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Holds the lock of the file at path, shared by every process, during the block"""
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def ensure(path, build):
+    """Writes the file at path with the (user ids, choices) returned by build, unless it exists"""
+    if os.path.exists(path):
+        return
+    with locked(path):
+        if not os.path.exists(path):
+            write(path, *build())
+
+
+def discard(prefix):
+    """Removes every file named after prefix, they are built again on next use"""
+    for path in glob.glob(glob.escape(prefix) + '-*.npy'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def _find(array, user_id):
+    """Index among the used rows of the mapping of a whole file of the row of user_id, or -1"""
+    sorted_count = int(_counters(array)[0])
+    rows = _rows(array)
+    i = int(np.searchsorted(rows[:sorted_count, 0], user_id))
+    if i < sorted_count and rows[i, 0] == user_id:
+        return i
+    appended = np.flatnonzero(rows[sorted_count:, 0] == user_id)
+    return sorted_count + int(appended[0]) if len(appended) else -1
+
+
+def _compact(path, extra=None):
+    """Writes the file at path again without its removed rows, plus the (user id, choices)
+    row extra if given. The lock must be held."""
+    _, array = _map(path)
+    rows = _rows(array)
+    if rows.shape[1] > 1:
+        rows = rows[rows[:, 1] != REMOVED]
+    user_ids, choices = rows[:, 0], rows[:, 1:]
+    if extra is not None:
+        user_ids, choices = np.append(user_ids, extra[0]), np.vstack([choices, [extra[1]]])
+    write(path, user_ids, np.asarray(choices))
+
+
+def compact(path):
+    """Sorts the rows appended to the file at path and drops the removed ones, if any"""
+    with locked(path):
+        if os.path.exists(path):
+            sorted_count, used, removed = _counters(_map(path)[1])
+            if sorted_count != used or removed:
+                _compact(path)
+
+
+# paths this process is compacting in the background
+_compacting = set()
+
+
+def _compact_later(path):
+    if path in _compacting:
+        return
+    _compacting.add(path)
+
+    def run():
+        try:
+            compact(path)
+        finally:
+            _compacting.discard(path)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def put_row(path, user_id, values):
+    """Makes the row of user_id hold the given choices, or removes it if values is None.
+    Does nothing if the file at path doesn't exist."""
+    try:
+        _, array = _current(path)
+    except FileNotFoundError:
+        return
+    row = _find(array, user_id)
+    rows = _rows(array)
+    if values is None and (row == -1 or _removed(rows[row])) or \
+            row != -1 and values is not None and (rows[row, 1:] == values).all():
+        return
+
+    with locked(path):
+        if not os.path.exists(path):
+            return
+        _, array = _map(path, mode='r+')
+        counters = _counters(array)
+        row = _find(array, user_id)
+        if row != -1:
+            rows = _rows(array)
+            counters[2] += int(values is None) - int(_removed(rows[row]))
+            rows[row, 1:] = REMOVED if values is None else values
+        elif values is None:
+            return
+        elif _header_rows(array.shape[1]) + counters[1] == len(array):  # no spare rows left
+            _compact(path, (user_id, values))
+            return
+        else:
+            at = _header_rows(array.shape[1]) + counters[1]
+            array[at, 0] = user_id
+            array[at, 1:] = values
+            counters[1] += 1  # after the row is written, readers only see complete rows
+        array.flush()
+        if counters[1] - counters[0] + counters[2] >= COMPACT_AFTER:
+            _compact_later(path)
+
+
+_pool = None
+
+
+def pool(processes):
+    """Process pool started on first use and kept for the life of this process"""
+    global _pool
+    if _pool is None:
+        # spawned, so they don't inherit the database connections or threads of the site
+        _pool = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def _score(path, inode, rows, values):
+    """Pool task: coincidences against values of the given rows of the file at path"""
+    current, array, _ = mapped(path)
+    if current != inode:
+        raise StaleMatrix(path)
+    return (array[rows, 1:] == values).sum(axis=1)
+
+
+def coincidences(path, inode, array, rows, values, processes=0, min_rows=0):
+    """Number of questions answered as values by each of the given rows of array, which
+    is the mapping of the file at path: all of them if rows is None, or an index array.
+    With at least min_rows rows, they are split among a pool of `processes` processes,
+    unless this is a daemon process, which can't start one."""
+    count = len(array) if rows is None else len(rows)
+    if processes > 1 and count >= max(min_rows, processes) and not multiprocessing.current_process().daemon:
+        bounds = np.linspace(0, count, processes + 1).astype(int)
+        chunks = [slice(a, b) if rows is None else rows[a:b] for a, b in zip(bounds, bounds[1:])]
+        try:
+            return np.concatenate(list(pool(processes).map(
+                _score, [path] * processes, [inode] * processes, chunks, [values] * processes)))
+        except StaleMatrix:  # this process still has the old file mapped
+            pass
+    selected = array[:, 1:] if rows is None else array[rows, 1:]
+    return (selected == values).sum(axis=1)
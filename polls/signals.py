@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .catalogue import get_catalogue, invalidate_catalogue
+from .database import apply_sqlite_pragmas
+from .fragments import invalidate_match_fragments
+from .images import refresh_renditions
+from .instrumentation import install_query_timer
+from .matching import update_shared_row
+from .models import AnswerVector, AppConfig, Choice, Question
+
+
+@receiver([post_save, post_delete], sender=AppConfig)
+def clear_app_config_cache(sender, **kwargs):
+    AppConfig.clear_cache()
+    invalidate_match_fragments()
+
+
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=Choice)
+def clear_catalogue(sender, **kwargs):
+    invalidate_catalogue()
+
+
+# the fields of a user shown in the match lists of others
+SHOWN_USER_FIELDS = ('username', 'email')
+
+
+@receiver(pre_save, sender=User)
+def remember_shown_fields(sender, instance, update_fields=None, raw=False, **kwargs):
+    # new users are in nobody's list yet, and logging in only saves last_login
+    if raw or instance.pk is None or update_fields is not None and not set(SHOWN_USER_FIELDS) & set(update_fields):
+        return
+    instance._shown_before = User.objects.filter(pk=instance.pk).values_list(*SHOWN_USER_FIELDS).first()
+
+
+@receiver(post_save, sender=User)
+def clear_match_fragments(sender, instance, created, **kwargs):
+    before = instance.__dict__.pop('_shown_before', None)
+    if not created and before is not None and before != tuple(getattr(instance, f) for f in SHOWN_USER_FIELDS):
+        invalidate_match_fragments()
+
+
+@receiver(post_delete, sender=User)
+def clear_match_fragments_of_deleted(sender, **kwargs):
+    # its Match rows go away without bumping the matches_version of the lists
+    invalidate_match_fragments()
+
+
+connection_created.connect(apply_sqlite_pragmas)
+connection_created.connect(install_query_timer)
+
+
+@receiver(post_save, sender=AppConfig)
+@receiver(post_save, sender=Choice)
+def make_image_renditions(sender, instance, update_fields=None, raw=False, **kwargs):
+    # saving the renditions themselves runs this again, with nothing left to do
+    if not raw and update_fields != frozenset(['renditions']):
+        refresh_renditions(instance)
+
+
+@receiver(post_delete, sender=AnswerVector)
+def drop_shared_row(sender, instance, **kwargs):
+    # deleted users must not be matched anymore, changed answers are stored when matching
+    if getattr(settings, 'POLLS_SHARED_MATRIX', None):
+        update_shared_row(instance.user_id, get_catalogue().questions, None)
@@ -0,0 +1,50 @@
+"""Cold start profile of the site. Run as `python -m polls.startup` with
+DJANGO_SETTINGS_MODULE set, it loads the apps, the URLconf and the WSGI and ASGI
+handlers in a fresh interpreter, and prints as JSON how long each step took and
+the SQL queries run meanwhile. See `manage.py startupprofile`."""
+import json
+import time
+
+
+def main():
+    phase = ['settings']
+    queries = []
+    connections = []
+
+    def record(execute, sql, params, many, context):
+        queries.append({'phase': phase[0], 'sql': sql})
+        return execute(sql, params, many, context)
+
+    def connected(sender, connection, **kwargs):
+        connections.append({'phase': phase[0], 'alias': connection.alias})
+        connection.execute_wrappers.insert(0, record)
+
+    from django.db.backends.signals import connection_created
+    connection_created.connect(connected)
+
+    timings = {}
+
+    def step(name, fn):
+        phase[0] = name
+        start = time.perf_counter()
+        fn()
+        timings[name] = (time.perf_counter() - start) * 1000.0
+
+    def load_urls():
+        from django.urls import get_resolver
+        get_resolver().url_patterns  # imports ROOT_URLCONF and everything it includes
+
+    import django
+    step('apps', django.setup)
+    step('urls', load_urls)
+
+    from django.core.asgi import get_asgi_application
+    from django.core.wsgi import get_wsgi_application
+    step('wsgi', get_wsgi_application)
+    step('asgi', get_asgi_application)
+
+    print(json.dumps({'timings': timings, 'queries': queries, 'connections': connections}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip variants are made without it
+    brotli = None
+
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.map', '.json', '.html')
+
+# name.0123456789ab.css as made by ManifestStaticFilesStorage
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^/]+$')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also stores gzip and, if the brotli module is
+    installed, brotli compressed copies of the text files next to their hashed copy,
+    as name.gz and name.br, for `serve` to send without compressing on every request."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        for name in set(self.hashed_files.values()):
+            if name.endswith(COMPRESSED_EXTENSIONS):
+                self._compress(name)
+
+    def _compress(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content)))
+        for extension, compressed in variants:
+            if len(compressed) < len(content):
+                if self.exists(name + extension):
+                    self.delete(name + extension)
+                self._save(name + extension, ContentFile(compressed))
+
+
+def serve(request, path):
+    """Serves a file collected into STATIC_ROOT, picking its precompressed variant when
+    the browser accepts it. Files with a hashed name never change, so browsers are told
+    to keep them for a year without asking again."""
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404(path)
+    if not os.path.isfile(fullpath):
+        raise Http404(path)
+
+    stat = os.stat(fullpath)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+        return HttpResponseNotModified()
+
+    accepted = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    served, encoding = fullpath, None
+    for extension, name in (('.br', 'br'), ('.gz', 'gzip')):
+        if name in accepted and os.path.isfile(fullpath + extension):
+            served, encoding = fullpath + extension, name
+            break
+
+    content_type, _ = mimetypes.guess_type(fullpath)
+    response = FileResponse(open(served, 'rb'), content_type=content_type or 'application/octet-stream',
+                            filename=os.path.basename(fullpath))
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = IMMUTABLE if HASHED_NAME.search(path) else 'public, max-age=0, must-revalidate'
+    return response
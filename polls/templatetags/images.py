@@ -0,0 +1,26 @@
+from django import template
+from django.utils.html import format_html
+
+from polls import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def picture(instance, field, sizes, **attrs):
+    """<picture> with the WebP renditions of the image field, falling back to the
+    original upload. Extra arguments become attributes of the <img>."""
+    image = getattr(instance, field)
+    if not image:
+        return ''
+    img = format_html('<img src="{}"{}>', image.url,
+                      format_html(''.join(' %s="{}"' % name.replace('_', '-') for name in attrs), *attrs.values()))
+    srcset = images.srcset(instance, field)
+    if not srcset:
+        return img
+    return format_html('<picture><source type="image/webp" srcset="{}" sizes="{}">{}</picture>', srcset, sizes, img)
+
+
+@register.simple_tag
+def rendition_url(instance, field):
+    return images.rendition_url(instance, field)
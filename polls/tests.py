@@ -1,3 +1,902 @@
-from django.test import TestCase
+import bisect
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db import OperationalError, connection
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import async_views, export, fragments, sharedmatrix, staticfiles, views
+from .admin import AppConfigAdmin, EstimatedCountPaginator, estimated_count
+from .catalogue import get_catalogue, invalidate_catalogue
+from .checks import check_session_cache
+from .instrumentation import BUCKETS, Histograms, histograms, percentile, report
+from .matching import (candidate_vectors, AnswerMatrix, load_candidates, rebuild_lsh_index, refresh_matches, top_k,
+                       update_matches)
+from .models import (Answer, AnswerVector, AppConfig, CatalogueGeneration, Choice, ChoiceCount, LshBucket, Match,
+                     MatchJob, Profile, Question, TimingBucket)
+from .routers import ReadReplicaRouter, replica_reads
+from .views import save_vote
+
+
+# a cache shared by every process, for POLLS_CONFIG_CACHE
+SHARED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'polls-tests'},
+}
+
+
+def make_questions(count, choices):
+    for i in range(count):
+        question = Question.objects.create(question_text="Pregunta %d" % i, pub_date=timezone.now())
+        for j in range(choices):
+            Choice.objects.create(question=question, choice_text="Opcion %d" % j)
+    return get_catalogue().questions
+
+
+class MatchingTestCase(TestCase):
+    """Random answers of 30 users to 6 questions of 3 choices, with random profiles"""
+    LIMIT = 5
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.questions = make_questions(6, 3)
+        self.users = []
+        for i in range(30):
+            user = User.objects.create(username="user%d" % i)
+            Profile.objects.create(user=user, gender=self.rng.choice('MF'), gender_preference=self.rng.choice('MF'))
+            vector = AnswerVector(user=user)
+            vector.set_choices([self.rng.randrange(3) for _ in self.questions])
+            vector.save()
+            self.users.append(user)
+
+    def expected_scores(self, user, gender_filter):
+        """Coincidences of the best LIMIT candidates of user, from a full recompute"""
+        matrix = AnswerMatrix.load(self.questions, candidate_vectors(user, gender_filter))
+        me = matrix.row_of(user.id)
+        if me == -1:
+            return []
+        coincidences = matrix.coincidences_against(me)
+        eligible = matrix.completed()
+        eligible[me] = False
+        return coincidences[top_k(coincidences, eligible, self.LIMIT)].tolist()
+
+    def assert_lists_match_recompute(self, gender_filter):
+        for user in self.users:
+            if AnswerVector.objects.filter(user=user, matches_stale=True).exists():
+                refresh_matches(user, self.questions, self.LIMIT, gender_filter)  # as on the next index visit
+
+        choices = {v.user_id: np.array(v.choices(len(self.questions))) for v in AnswerVector.objects.all()}
+        stored = {}
+        for user_id, candidate_id, c in Match.objects.order_by('-coincidences', 'candidate_id') \
+                .values_list('user_id', 'candidate_id', 'coincidences'):
+            stored.setdefault(user_id, []).append(c)
+            self.assertEqual(c, int((choices[user_id] == choices[candidate_id]).sum()))
+        for user in self.users:
+            self.assertEqual(stored.get(user.id, []), self.expected_scores(user, gender_filter), user)
+
+    def simulate(self, gender_filter, steps=100):
+        for user in self.users:
+            refresh_matches(user, self.questions, self.LIMIT, gender_filter)
+
+        for _ in range(steps):
+            user = self.rng.choice(self.users)
+            vector = AnswerVector.objects.get(user=user)
+            # unanswering a question drops the user out of every list until it answers again
+            choice = self.rng.randrange(-1, 3) if self.rng.random() < 0.1 else self.rng.randrange(3)
+            vector.set_choice(self.rng.randrange(len(self.questions)), choice, len(self.questions))
+            vector.save()
+            update_matches(user, self.questions, self.LIMIT, gender_filter)
+            self.assert_lists_match_recompute(gender_filter)
+
+
+class UpdateMatchesTests(MatchingTestCase):
+    def test_patched_lists_match_full_recompute(self):
+        self.simulate(gender_filter=False)
+
+    def test_patched_lists_match_full_recompute_with_gender_filter(self):
+        self.simulate(gender_filter=True)
+
+
+class ApproximateMatchingTests(MatchingTestCase):
+    def test_lists_come_from_the_lsh_index(self):
+        # one band per question: every user sharing an answer is a candidate, like exact
+        with override_settings(POLLS_MATCHING_MODE='approximate', POLLS_LSH_BANDS=6, POLLS_LSH_BAND_SIZE=1):
+            self.assertEqual(rebuild_lsh_index(self.questions), len(self.users))
+            self.assertEqual(LshBucket.objects.count(), 6 * len(self.users))
+            self.simulate(gender_filter=False, steps=30)
+
+    def test_users_without_the_index_are_not_candidates(self):
+        with override_settings(POLLS_MATCHING_MODE='approximate', POLLS_LSH_BANDS=6, POLLS_LSH_BAND_SIZE=1):
+            refresh_matches(self.users[0], self.questions, self.LIMIT)
+        self.assertFalse(Match.objects.filter(user=self.users[0]).exists())
+
+
+class SharedMatrixTests(MatchingTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'matrix.npy')
+        self.prefix = os.path.join(tmp.name, 'answers')
+
+    def contents(self):
+        _, rows, order = sharedmatrix.mapped(self.path)
+        rows = rows if order is None else rows[order]
+        return {int(row[0]): row[1:].tolist() for row in rows}
+
+    def test_rows_are_changed_in_place_until_compacted(self):
+        sharedmatrix.write(self.path, np.array([3, 1]), np.array([[0, 1], [2, 2]]))
+        inode = os.stat(self.path).st_ino
+        sharedmatrix.put_row(self.path, 2, np.array([1, 1]))
+        sharedmatrix.put_row(self.path, 3, None)
+        sharedmatrix.put_row(self.path, 1, np.array([0, 0]))
+        self.assertEqual(self.contents(), {1: [0, 0], 2: [1, 1]})
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+
+        sharedmatrix.put_row(self.path, 3, np.array([2, 0]))  # back into its removed row
+        self.assertEqual(self.contents(), {1: [0, 0], 2: [1, 1], 3: [2, 0]})
+        _, rows, order = sharedmatrix.mapped(self.path)
+        self.assertEqual(rows[:, 0].tolist(), [1, 3, 2])
+        self.assertEqual(order.tolist(), [0, 2, 1])
+
+        sharedmatrix.compact(self.path)
+        _, rows, order = sharedmatrix.mapped(self.path)
+        self.assertIsNone(order)
+        self.assertEqual(rows.tolist(), [[1, 0, 0], [2, 1, 1], [3, 2, 0]])
+
+    def test_appending_without_spare_rows_compacts(self):
+        sharedmatrix.write(self.path, np.array([1]), np.array([[0]]))
+        rows = len(np.load(self.path, mmap_mode='r'))
+        for user_id in range(2, rows + 2):
+            sharedmatrix.put_row(self.path, user_id, np.array([user_id % 3]))
+        self.assertEqual(self.contents(), {1: [0], **{user_id: [user_id % 3] for user_id in range(2, rows + 2)}})
+        self.assertGreater(len(np.load(self.path, mmap_mode='r')), rows)
+
+    def test_daemon_processes_score_in_process(self):
+        sharedmatrix.write(self.path, np.array([1, 2]), np.array([[0, 1], [0, 2]]))
+        inode, rows, _ = sharedmatrix.mapped(self.path)
+        process = multiprocessing.current_process()
+        process.daemon = True
+        try:
+            scores = sharedmatrix.coincidences(self.path, inode, rows, None, np.array([0, 1]), processes=2)
+        finally:
+            process.daemon = False
+        self.assertEqual(scores.tolist(), [2, 1])
+        self.assertIsNone(sharedmatrix._pool)
+
+    def test_lists_from_the_shared_matrix_match_full_recompute(self):
+        # removed rows get compacted away in the background along the way
+        with override_settings(POLLS_SHARED_MATRIX=self.prefix), mock.patch.object(sharedmatrix, 'COMPACT_AFTER', 2):
+            self.simulate(gender_filter=False, steps=40)
+            self.simulate(gender_filter=True, steps=40)
+
+
+class AppConfigAdminTests(TestCase):
+    def save(self, cfg, **changes):
+        for name, value in changes.items():
+            setattr(cfg, name, value)
+        form = SimpleNamespace(changed_data=list(changes))  # all save_model reads from the form
+        AppConfigAdmin(AppConfig, site).save_model(RequestFactory().post('/'), cfg, form, change=True)
+
+    def test_only_matching_settings_flag_lists_stale(self):
+        cfg = AppConfig.objects.create()
+        vector = AnswerVector.objects.create(user=User.objects.create(username="user"), matches_stale=False)
+
+        self.save(cfg, color_fondo='#000000', frase_logo="Otro")
+        vector.refresh_from_db()
+        self.assertFalse(vector.matches_stale)
+
+        self.save(cfg, afinidad_cantidad_gente=cfg.afinidad_cantidad_gente + 1)
+        vector.refresh_from_db()
+        self.assertTrue(vector.matches_stale)
+
+
+class SubmitAnswersTests(TestCase):
+    def setUp(self):
+        self.questions = make_questions(3, 2)
+        self.user = User.objects.create(username="user")
+        self.client.force_login(self.user)
+
+    def post(self, body):
+        return self.client.post('/answers/', body if isinstance(body, str) else json.dumps(body),
+                                content_type='application/json')
+
+    def test_login_required(self):
+        self.client.logout()
+        self.assertEqual(self.post({'choices': [0]}).status_code, 401)
+
+    def test_invalid_bodies_are_rejected_without_saving(self):
+        for body in ['not json', {}, {'choices': 1}, {'choices': [0, 0, 0, 0]},
+                     {'choices': [0, 2]}, {'choices': [-1]}, {'choices': [True]}, {'choices': ["0"]}]:
+            self.assertEqual(self.post(body).status_code, 400, body)
+        self.assertFalse(Answer.objects.exists())
+        self.assertFalse(AnswerVector.objects.exists())
+
+    def test_saves_answers_and_skips_nulls(self):
+        response = self.post({'choices': [1, None, 0]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'saved': 2, 'has_completed_poll': False, 'first_unanswered': 1})
+        self.assertEqual(AnswerVector.objects.get(user=self.user).choices(3), [1, -1, 0])
+
+        response = self.post({'choices': [None, 1]})
+        self.assertEqual(response.json(), {'saved': 1, 'has_completed_poll': True, 'first_unanswered': -1})
+        self.assertEqual(sorted(Answer.objects.values_list('question_id', 'choice')),
+                         [(self.questions[0].id, 1), (self.questions[1].id, 1), (self.questions[2].id, 0)])
+
+
+class VoteTests(TestCase):
+    def setUp(self):
+        self.questions = make_questions(2, 3)
+        self.user = User.objects.create(username="user")
+        self.client.force_login(self.user)
+
+    def vector(self):
+        return AnswerVector.objects.get(user=self.user)
+
+    def test_upsert_creates_then_updates_one_row(self):
+        question = self.questions[0]
+        Answer.upsert(self.user, {question.id: 1})
+        Answer.upsert(self.user, {question.id: 2})
+        self.assertEqual(list(Answer.objects.filter(user=self.user).values_list('question_id', 'choice')),
+                         [(question.id, 2)])
+
+    def test_out_of_range_choices_are_rejected(self):
+        self.client.post('/0/vote/', {'choice': '1'})
+        self.client.post('/1/vote/', {'choice': '0'})
+        self.assertTrue(self.vector().completed)
+
+        for choice in ['-1', '3', '99', 'x']:
+            self.assertEqual(self.client.post('/0/vote/', {'choice': choice}).status_code, 400, choice)
+        self.assertEqual(self.client.post('/5/vote/', {'choice': '0'}).status_code, 404)
+        response = self.client.post('/0/vote/', {'choice': '<script>'})
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertNotIn(b'<script>', response.content)
+
+        self.assertTrue(self.vector().completed)
+        self.assertEqual(self.vector().choices(2), [1, 0])
+        self.assertEqual(Answer.objects.get(user=self.user, question=self.questions[0]).choice, 1)
+
+    def test_answering_the_last_question_completes_the_poll(self):
+        self.assertRedirects(self.client.post('/0/vote/', {'choice': '2'}), '/1/', fetch_redirect_response=False)
+        self.assertFalse(self.vector().completed)
+        self.assertFalse(MatchJob.objects.exists())
+
+        self.assertRedirects(self.client.post('/1/vote/', {'choice': '0'}), '/', fetch_redirect_response=False)
+        self.assertTrue(self.vector().completed)
+        self.assertTrue(MatchJob.objects.get(user=self.user).update_others)
+
+        MatchJob.objects.all().delete()
+        self.client.post('/0/vote/', {'choice': '1'})  # changing an answer keeps it completed
+        self.assertTrue(self.vector().completed)
+        self.assertEqual(self.vector().choices(2), [1, 0])
+        self.assertTrue(MatchJob.objects.filter(user=self.user).exists())
+
+
+class AsyncVoteTests(TransactionTestCase):
+    """The async views read in other threads, which only see committed rows"""
+
+    def test_out_of_range_choices_are_rejected(self):
+        make_questions(1, 3)
+        user = User.objects.create(username="user")
+        for choice in ['-1', '3', 'x']:
+            request = RequestFactory().post('/0/vote/', {'choice': choice})
+            request.user = user
+            self.assertEqual(async_to_sync(async_views.vote)(request, 0).status_code, 400, choice)
+        self.assertFalse(Answer.objects.exists())
+
+
+
+class ChoiceCountTests(TestCase):
+    def setUp(self):
+        self.questions = make_questions(2, 3)
+        self.users = [User.objects.create(username="user%d" % i) for i in range(3)]
+
+    def counts(self):
+        return dict(((q, c), v) for q, c, v in ChoiceCount.objects.filter(votes__gt=0)
+                    .values_list('question_id', 'choice', 'votes'))
+
+    def test_revotes_move_the_vote_between_choices(self):
+        first, second = (q.id for q in self.questions)
+        Answer.upsert(self.users[0], {first: 0, second: 1})
+        Answer.upsert(self.users[1], {first: 0})
+        self.assertEqual(self.counts(), {(first, 0): 2, (second, 1): 1})
+
+        Answer.upsert(self.users[0], {first: 2})
+        Answer.upsert(self.users[1], {first: 0})  # same answer again
+        self.assertEqual(self.counts(), {(first, 0): 1, (first, 2): 1, (second, 1): 1})
+
+        Answer.upsert(self.users[2], {first: 2, second: 1})
+        self.assertEqual(self.counts(), {(first, 0): 1, (first, 2): 2, (second, 1): 2})
+        self.assertEqual(ChoiceCount.reconcile(), 0)
+
+    def test_reconcile_fixes_drift(self):
+        first = self.questions[0].id
+        Answer.upsert(self.users[0], {first: 1})
+        ChoiceCount.add({(first, 1): 5, (first, 2): 1})
+        self.assertEqual(ChoiceCount.reconcile(), 2)
+        self.assertEqual(self.counts(), {(first, 1): 1})
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class DetailConditionalTests(TestCase):
+    def setUp(self):
+        self.cfg = AppConfig.objects.create()
+        self.questions = make_questions(2, 3)
+        self.client.force_login(User.objects.create(username="user"))
+        self.client.get('/0/')  # sets the CSRF cookie the form holds the token of
+
+    def etag(self):
+        response = self.client.get('/0/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        return response['ETag']
+
+    def assert_not_modified(self, etag, expected=True):
+        status = self.client.get('/0/', HTTP_IF_NONE_MATCH=etag).status_code
+        self.assertEqual(status, 304 if expected else 200)
+
+    def test_unchanged_page_is_not_modified(self):
+        etag = self.etag()
+        self.assertTrue(etag.startswith('W/"'))  # the masked CSRF token changes the body every time
+        self.assert_not_modified(etag)
+        self.assertEqual(self.etag(), etag)
+
+    def test_answer_is_read_once(self):
+        self.client.post('/0/vote/', {'choice': '1'})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/0/')
+        self.assertEqual(response.context['answer_index'], 1)
+        self.assertEqual(len([q for q in queries if 'FROM "polls_answer"' in q['sql']]), 1)
+
+    def test_new_release_changes_the_etag(self):
+        etag = self.etag()
+        self.addCleanup(views.deploy_version.cache_clear)
+        with override_settings(POLLS_DEPLOY_VERSION='nueva'):
+            views.deploy_version.cache_clear()
+            self.assert_not_modified(etag, False)
+
+    def test_vote_changes_the_etag(self):
+        etag = self.etag()
+        self.client.post('/0/vote/', {'choice': '1'})
+        self.assert_not_modified(etag, False)
+        etag = self.etag()
+        self.assert_not_modified(etag)
+
+        self.client.post('/0/vote/', {'choice': '2'})
+        self.assert_not_modified(etag, False)
+
+    def test_catalogue_and_config_changes_change_the_etag(self):
+        etag = self.etag()
+        question = Question.objects.get(pk=self.questions[0].id)
+        question.question_text = "Otra pregunta"
+        question.save()
+        self.assert_not_modified(etag, False)
+
+        etag = self.etag()
+        self.cfg.frase_logo = "Otra frase"
+        self.cfg.save()
+        self.assert_not_modified(etag, False)
+
+    def test_if_modified_since_alone_never_gets_not_modified(self):
+        self.client.post('/0/vote/', {'choice': '1'})
+        since = self.client.get('/0/', HTTP_IF_MODIFIED_SINCE='Tue, 01 Jan 2030 00:00:00 GMT')
+        self.assertEqual(since.status_code, 200)
+
+
+class VectorSaveTests(TestCase):
+    """Saving answers must not undo the match list state a worker wrote meanwhile"""
+
+    def setUp(self):
+        self.questions = make_questions(2, 3)
+        self.user = User.objects.create(username="user")
+        self.vector = AnswerVector.objects.create(user=self.user)
+
+    def worker_updates_list(self):
+        AnswerVector.objects.filter(user=self.user).update(matches_stale=False, match_floor=3, matches_version=7)
+
+    def assert_list_state_kept(self):
+        vector = AnswerVector.objects.get(user=self.user)
+        self.assertEqual((vector.matches_stale, vector.match_floor, vector.matches_version), (False, 3, 7))
+        return vector
+
+    def test_vote(self):
+        self.worker_updates_list()
+        with mock.patch.object(AnswerVector.objects, 'get_or_create', return_value=(self.vector, False)):
+            save_vote(self.user, 0, 1)
+        self.assertEqual(self.assert_list_state_kept().choices(2), [1, -1])
+
+    def test_submit_answers(self):
+        self.client.force_login(self.user)
+        self.worker_updates_list()
+        with mock.patch.object(AnswerVector.objects, 'get_or_create', return_value=(self.vector, False)):
+            self.client.post('/answers/', json.dumps({'choices': [2, 0]}), content_type='application/json')
+        vector = self.assert_list_state_kept()
+        self.assertTrue(vector.completed)
+
+    def test_refresh(self):
+        Answer.upsert(self.user, {self.questions[1].id: 2})
+        self.worker_updates_list()
+        with mock.patch.object(AnswerVector.objects, 'get_or_create', return_value=(self.vector, False)):
+            AnswerVector.refresh(self.user, self.questions)
+        self.assertEqual(self.assert_list_state_kept().choices(2), [-1, 2])
+
+
+class CatalogueTests(TestCase):
+    def test_changes_from_other_processes_are_seen_on_next_use(self):
+        questions = make_questions(2, 2)
+        # as another process would: no signal reaches the copy of this one
+        Question.objects.filter(pk=questions[0].id).update(question_text="Cambiada")
+        Question.objects.bulk_create([Question(question_text="Nueva", pub_date=timezone.now())])
+        self.assertEqual([q.question_text for q in get_catalogue()], ["Pregunta 0", "Pregunta 1"])
+
+        CatalogueGeneration.bump()
+        catalogue = get_catalogue()
+        self.assertEqual([q.question_text for q in catalogue], ["Cambiada", "Pregunta 1", "Nueva"])
+        with self.assertNumQueries(1):
+            self.assertIs(get_catalogue(), catalogue)
+
+    def test_saves_and_deletes_rebuild_it(self):
+        questions = make_questions(2, 2)
+        catalogue = get_catalogue()
+        self.assertEqual(catalogue.position_of(questions[1].id), 1)
+        self.assertEqual([c.choice_text for c in catalogue[0].choices], ["Opcion 0", "Opcion 1"])
+
+        Choice.objects.create(question=questions[0], choice_text="Opcion 2")
+        self.assertEqual(len(get_catalogue()[0].choices), 3)
+        Choice.objects.filter(question=questions[0], choice_text="Opcion 0").delete()
+        self.assertEqual([c.choice_text for c in get_catalogue()[0].choices], ["Opcion 1", "Opcion 2"])
+
+        question = Question.objects.get(pk=questions[0].id)
+        question.delete()
+        catalogue = get_catalogue()
+        self.assertEqual(len(catalogue), 1)
+        self.assertEqual(catalogue.position_of(questions[1].id), 0)
+        self.assertEqual(catalogue.position_of(questions[0].id), -1)
+
+    @override_settings(CACHES=SHARED_CACHES, POLLS_CONFIG_CACHE='shared')
+    def test_shared_cache_replaces_the_query(self):
+        questions = make_questions(1, 2)
+        catalogue = get_catalogue()
+        with self.assertNumQueries(0):
+            self.assertIs(get_catalogue(), catalogue)
+        Question.objects.filter(pk=questions[0].id).update(question_text="Cambiada")
+        invalidate_catalogue()  # as the signals of another process do
+        self.assertEqual(get_catalogue()[0].question_text, "Cambiada")
+
+
+@override_settings(POLLS_WRITE_RETRIES=50)
+class ConcurrentMatchingTests(TransactionTestCase):
+    """Workers recomputing at the same time, each thread with its own connection"""
+    LIMIT = 2
+
+    def vector(self, username, choices):
+        user = User.objects.create(username=username)
+        vector = AnswerVector(user=user)
+        vector.set_choices(choices)
+        vector.save()
+        return user
+
+    def run_concurrently(self, calls):
+        barrier = threading.Barrier(len(calls))
+        errors = []
+
+        def run(fn, user):
+            try:
+                barrier.wait()
+                fn(user, self.questions, self.LIMIT)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=call) for call in calls]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_users_entering_the_same_full_list(self):
+        self.questions = make_questions(4, 2)
+        owner = self.vector("owner", [0, 0, 0, 0])
+        for i in range(2):
+            self.vector("old%d" % i, [0, 0, 1, 1])
+        refresh_matches(owner, self.questions, self.LIMIT)
+        self.assertEqual(AnswerVector.objects.get(user=owner).match_floor, 2)
+
+        new = [self.vector("new%d" % i, [0, 0, 0, 1]) for i in range(4)]
+        self.run_concurrently([(update_matches, user) for user in new] + [(refresh_matches, owner)] * 2)
+
+        stored = list(Match.objects.filter(user=owner).order_by('-coincidences', 'candidate_id')
+                      .values_list('candidate_id', 'coincidences'))
+        self.assertEqual(stored, [(new[0].id, 3), (new[1].id, 3)])
+        self.assertEqual(AnswerVector.objects.get(user=owner).match_floor, 3)
+
+
+class HistogramFlushTests(TestCase):
+    def setUp(self):
+        self.histograms = Histograms()
+
+    def buckets(self):
+        return {(b.endpoint, b.metric, b.upper_bound): b.count for b in TimingBucket.objects.all()}
+
+    def test_counts_are_added_to_existing_buckets(self):
+        self.histograms.record('polls:index', 'total', 3)
+        self.histograms.flush()
+        self.histograms.record('polls:index', 'total', 4)
+        self.histograms.record('polls:index', 'db', 0.5)
+        self.histograms.flush()
+        self.assertEqual(self.buckets(), {('polls:index', 'total', 5): 2, ('polls:index', 'db', 1): 1})
+
+    def test_failed_flush_keeps_the_counts(self):
+        self.histograms.record('polls:index', 'total', 3)
+        with mock.patch.object(TimingBucket, 'add', side_effect=OperationalError("database is locked")):
+            self.histograms.flush()
+        self.assertFalse(TimingBucket.objects.exists())
+        self.histograms.flush()
+        self.assertEqual(self.buckets(), {('polls:index', 'total', 5): 1})
+
+    @override_settings(POLLS_METRICS_FLUSH_INTERVAL=0)
+    def test_failed_flush_does_not_fail_the_request(self):
+        self.client.force_login(User.objects.create(username="user"))
+        with mock.patch.object(TimingBucket, 'add', side_effect=OperationalError("database is locked")):
+            response = self.client.post('/answers/', json.dumps({'choices': []}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+
+class MatchFragmentInvalidationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="user", email="user@example.com")
+
+    def assert_invalidates(self, expected, change):
+        with mock.patch('polls.signals.invalidate_match_fragments') as invalidate:
+            change()
+        self.assertEqual(invalidate.called, expected)
+
+    def test_signups_and_logins_keep_the_lists(self):
+        self.assert_invalidates(False, lambda: User.objects.create_user("new", "new@example.com", "secreto123"))
+        self.user.last_login = timezone.now()
+        self.assert_invalidates(False, lambda: self.user.save(update_fields=['last_login']))
+        self.user.first_name = "Ana"
+        self.assert_invalidates(False, self.user.save)
+
+    def test_shown_fields_and_deletes_clear_the_lists(self):
+        self.user.email = "otro@example.com"
+        self.assert_invalidates(True, self.user.save)
+        self.user.username = "otro"
+        self.assert_invalidates(True, lambda: self.user.save(update_fields=['username']))
+        self.assert_invalidates(True, self.user.delete)
+
+
+class MatchFragmentCacheTests(TestCase):
+    def setUp(self):
+        self.cfg = AppConfig.objects.create()
+        self.user = User.objects.create(username="user")
+        self.vector = SimpleNamespace(matches_version=0)
+        fragments.fragments.clear()
+
+    def renders(self):
+        """Whether match_fragment had to render the list again"""
+        with mock.patch.object(fragments, 'get_matches', return_value=[]) as get_matches:
+            self.assertEqual(fragments.match_fragment(self.user, self.vector, get_catalogue(), AppConfig.get())[1], 0)
+        return get_matches.called
+
+    def test_lists_are_reused_until_they_change(self):
+        self.assertTrue(self.renders())
+        self.assertFalse(self.renders())
+        self.vector.matches_version += 1
+        self.assertTrue(self.renders())
+        self.assertFalse(self.renders())
+        make_questions(1, 2)
+        self.assertTrue(self.renders())
+
+    def test_configuration_and_shown_fields_clear_the_lists(self):
+        self.renders()
+        self.cfg.save()
+        self.assertTrue(self.renders())
+        self.user.username = "otro"
+        self.user.save()
+        self.assertTrue(self.renders())
+        User.objects.create(username="new").delete()
+        self.assertTrue(self.renders())
+        AppConfig.objects.create()
+        self.renders()
+        AppConfig.objects.last().delete()
+        self.assertTrue(self.renders())
+
+    @override_settings(CACHES=SHARED_CACHES, POLLS_CONFIG_CACHE='shared')
+    def test_other_processes_clear_the_lists(self):
+        self.renders()
+        self.assertFalse(self.renders())
+        caches['shared'].set(fragments.GENERATION_KEY, 'other', timeout=None)
+        self.assertTrue(self.renders())
+
+    @override_settings(POLLS_FRAGMENT_TIMEOUT=0)
+    def test_lists_expire(self):
+        self.renders()
+        self.assertTrue(self.renders())
+
+
+@mock.patch.object(export, 'BATCH_SIZE', 2)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.questions = make_questions(3, 2)
+        self.users = [User.objects.create(username=name) for name in ("ana", "juan, el otro", "luz")]
+        for user, choices in zip(self.users, ([0, 1, 1], [0, -1, 1], [])):
+            vector = AnswerVector(user=user)
+            vector.set_choices(choices)
+            vector.save()
+        ana, juan, luz = self.users
+        Match.objects.bulk_create([Match(user=ana, candidate=juan, coincidences=2),
+                                   Match(user=ana, candidate=luz, coincidences=0),
+                                   Match(user=juan, candidate=ana, coincidences=2),
+                                   Match(user=juan, candidate=luz, coincidences=2)])
+
+    def test_answers(self):
+        ana, juan, luz = (u.id for u in self.users)
+        q = [question.id for question in self.questions]
+        self.assertEqual(''.join(export.csv_lines('answers')),
+                         'user_id,username,completed,q%d,q%d,q%d\r\n' % tuple(q) +
+                         '%d,ana,1,0,1,1\r\n' % ana +
+                         '%d,"juan, el otro",0,0,,1\r\n' % juan +
+                         '%d,luz,0,,,\r\n' % luz)
+
+    def test_matches(self):
+        ana, juan, luz = (u.id for u in self.users)
+        self.assertEqual(''.join(export.csv_lines('matches')),
+                         'user_id,candidate_id,coincidences,score\r\n' +
+                         '%d,%d,2,66\r\n%d,%d,0,0\r\n' % (ana, juan, ana, luz) +
+                         '%d,%d,2,66\r\n%d,%d,2,66\r\n' % (juan, ana, juan, luz))
+
+    def test_staff_only_view(self):
+        self.client.force_login(self.users[0])
+        self.assertEqual(self.client.get('/export/matches.csv').status_code, 302)
+
+        self.client.force_login(User.objects.create(username="admin", is_staff=True))
+        response = self.client.get('/export/matches.csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="matches.csv"')
+        self.assertEqual(b''.join(response.streaming_content).decode(), ''.join(export.csv_lines('matches')))
+        self.assertEqual(self.client.get('/export/users.csv').status_code, 404)
+
+
+@override_settings(POLLS_READ_DATABASE='replica')
+class ReadReplicaTests(TestCase):
+    """The 'replica' alias isn't configured, reading from it raises"""
+
+    def setUp(self):
+        self.questions = make_questions(3, 2)
+        self.user, self.other = User.objects.create(username="user"), User.objects.create(username="otro")
+        for user in (self.user, self.other):
+            vector = AnswerVector(user=user)
+            vector.set_choices([0, 1, 1])
+            vector.save()
+
+    def load_behind(self, rows):
+        """load_candidates() with a replica holding the given answers by user"""
+        routed = []
+
+        def load(questions, vectors):
+            routed.append(ReadReplicaRouter().db_for_read(AnswerVector))
+            return AnswerMatrix(np.array(sorted(rows)), np.array([rows[u] for u in sorted(rows)]))
+
+        with mock.patch.object(AnswerMatrix, 'load', load):
+            matrix = load_candidates(self.user, self.questions, False)[1]
+        self.assertEqual(routed, ['replica'])
+        return {user_id: matrix.choices[matrix.row_of(user_id)].tolist() for user_id in matrix.user_ids}
+
+    def test_own_row_comes_from_default(self):
+        self.assertEqual(self.load_behind({self.user.id: [1, 1, 1], self.other.id: [0, 0, 0]}),
+                         {self.user.id: [0, 1, 1], self.other.id: [0, 0, 0]})
+        self.assertEqual(self.load_behind({self.other.id: [0, 0, 0]}),
+                         {self.user.id: [0, 1, 1], self.other.id: [0, 0, 0]})
+
+        AnswerVector.objects.filter(user=self.user).update(completed=False)
+        self.assertEqual(self.load_behind({self.user.id: [1, 1, 1], self.other.id: [0, 0, 0]}),
+                         {self.other.id: [0, 0, 0]})
+
+    def test_router(self):
+        router = ReadReplicaRouter()
+        self.assertIsNone(router.db_for_read(AnswerVector))
+        with replica_reads():
+            self.assertEqual(router.db_for_read(AnswerVector), 'replica')
+            self.assertEqual(router.db_for_write(AnswerVector), 'default')
+        self.assertIsNone(router.db_for_read(AnswerVector))
+        self.assertFalse(router.allow_migrate('replica', 'polls'))
+        self.assertIsNone(router.allow_migrate('default', 'polls'))
+
+
+class StaticFilesTests(TestCase):
+    CSS = b"body { color: black; }\n" * 50
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        self.storage = staticfiles.PrecompressedManifestStaticFilesStorage(location=self.root)
+        for name, content in (('site.0123456789ab.css', self.CSS), ('site.css', self.CSS), ('tiny.js', b"1")):
+            self.storage.save(name, ContentFile(content))
+        override = override_settings(STATIC_ROOT=self.root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get(self, path, **headers):
+        response = staticfiles.serve(RequestFactory().get('/static/' + path, **headers), path)
+        if response.status_code == 200:
+            response.content_bytes = b''.join(response.streaming_content)
+            response.close()
+        return response
+
+    def test_precompressed_variants(self):
+        self.storage._compress('site.0123456789ab.css')
+        self.storage._compress('tiny.js')
+        self.assertEqual(gzip.decompress(self.storage.open('site.0123456789ab.css.gz').read()), self.CSS)
+        self.assertFalse(self.storage.exists('tiny.js.gz'))  # no smaller compressed
+        with open(os.path.join(self.root, 'site.0123456789ab.css.br'), 'wb') as f:
+            f.write(b"brotli")
+
+        gzipped = self.storage.open('site.0123456789ab.css.gz').read()
+        for accepted, encoding, content in (('gzip, deflate, br', 'br', b"brotli"),
+                                            ('gzip, deflate', 'gzip', gzipped),
+                                            ('', None, self.CSS)):
+            response = self.get('site.0123456789ab.css', HTTP_ACCEPT_ENCODING=accepted)
+            self.assertEqual(response.get('Content-Encoding'), encoding)
+            self.assertEqual(response.content_bytes, content)
+            self.assertEqual(response['Content-Type'], 'text/css')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertIsNone(self.get('tiny.js', HTTP_ACCEPT_ENCODING='gzip').get('Content-Encoding'))
+
+    def test_cache_headers(self):
+        self.assertEqual(self.get('site.0123456789ab.css')['Cache-Control'], staticfiles.IMMUTABLE)
+        response = self.get('site.css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=0, must-revalidate')
+        self.assertEqual(self.get('site.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get('site.css', HTTP_IF_MODIFIED_SINCE='Mon, 01 Jan 2001 00:00:00 GMT').status_code, 200)
+
+    def test_missing_files(self):
+        for path in ('other.css', '../settings.py', ''):
+            with self.assertRaises(Http404):
+                self.get(path)
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        questions = make_questions(3, 2)
+        for i in range(4):
+            Answer.upsert(User.objects.create(username="user%d" % i), {q.id: i % 2 for q in questions})
+        Answer.objects.filter(pk__in=Answer.objects.order_by('id').values('id')[:2]).delete()
+        self.highest = Answer.objects.order_by('-id').values_list('id', flat=True).first()
+
+    def count(self, queryset):
+        with CaptureQueriesContext(connection) as queries:
+            count = EstimatedCountPaginator(queryset, 10).count
+        return count, any('COUNT(' in q['sql'] for q in queries.captured_queries)
+
+    def test_small_tables_are_counted(self):
+        self.assertEqual(estimated_count(Answer, 'default'), self.highest)
+        self.assertEqual(self.count(Answer.objects.order_by('id')), (10, True))
+
+    @mock.patch.object(EstimatedCountPaginator, 'ESTIMATE_MIN_ROWS', 5)
+    def test_big_tables_are_estimated(self):
+        self.assertEqual(self.count(Answer.objects.order_by('-id')), (self.highest, False))
+        self.assertEqual(self.count(Answer.objects.filter(choice=0).order_by('id')), (4, True))
+        Answer.objects.all().delete()
+        self.assertIsNone(estimated_count(Answer, 'default'))
+        self.assertEqual(self.count(Answer.objects.order_by('id')), (0, True))
+
+
+class AsyncReadStepTests(TransactionTestCase):
+    def test_read_steps_close_their_connections(self):
+        threads = []
+
+        def step():
+            threads.append(threading.get_ident())
+            return Question.objects.count()
+
+        closed = mock.Mock(side_effect=lambda: threads.append(threading.get_ident()))
+        with mock.patch.object(async_views.connections, 'close_all', closed):
+            self.assertEqual(async_to_sync(async_views._read(step))(), 0)
+        # in the thread that ran the step, not the one of the request
+        self.assertEqual(len(threads), 2)
+        self.assertEqual(threads[0], threads[1])
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+
+class SessionCacheCheckTests(TestCase):
+    def test_cached_sessions_need_a_shared_cache(self):
+        self.assertEqual(check_session_cache(None), [])
+        engine = 'django.contrib.sessions.backends.cached_db'
+        private = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(SESSION_ENGINE=engine, SESSION_CACHE_ALIAS='default', CACHES=private):
+            self.assertEqual([e.id for e in check_session_cache(None)], ['polls.E001'])
+        shared = dict(private, sessions={'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+                                         'LOCATION': '127.0.0.1:11211'})
+        with override_settings(SESSION_ENGINE=engine, SESSION_CACHE_ALIAS='sessions', CACHES=shared):
+            self.assertEqual(check_session_cache(None), [])
+
+
+class AppConfigCacheTests(TestCase):
+    def setUp(self):
+        self.cfg = AppConfig.objects.create(frase_logo="Primera")
+
+    def test_kept_in_the_process_until_saved_or_deleted(self):
+        self.assertEqual(AppConfig.get().frase_logo, "Primera")
+        with self.assertNumQueries(0):
+            AppConfig.get()
+
+        AppConfig.objects.update(frase_logo="Sin señal")  # no signal: the copy is kept
+        self.assertEqual(AppConfig.get().frase_logo, "Primera")
+
+        self.cfg.frase_logo = "Segunda"
+        self.cfg.save()
+        self.assertEqual(AppConfig.get().frase_logo, "Segunda")
+
+        self.cfg.delete()
+        self.assertIsNone(AppConfig.get())
+
+    @override_settings(POLLS_CONFIG_TIMEOUT=0)
+    def test_expires_after_the_timeout(self):
+        AppConfig.get()
+        AppConfig.objects.update(frase_logo="Sin señal")
+        self.assertEqual(AppConfig.get().frase_logo, "Sin señal")
+
+    @override_settings(CACHES=SHARED_CACHES, POLLS_CONFIG_CACHE='shared')
+    def test_shared_between_processes_through_the_cache(self):
+        AppConfig.clear_cache()
+        self.assertEqual(AppConfig.get().frase_logo, "Primera")
+        AppConfig._memo = None  # as another process, with nothing in memory
+        with self.assertNumQueries(0):
+            self.assertEqual(AppConfig.get().frase_logo, "Primera")
+
+        self.cfg.frase_logo = "Segunda"
+        self.cfg.save()
+        AppConfig._memo = None
+        self.assertEqual(AppConfig.get().frase_logo, "Segunda")
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        AppConfig.objects.create()
+        make_questions(1, 2)
+        self.client.force_login(User.objects.create(username="user"))
+        histograms.flush()  # whatever earlier requests left
+
+    def test_server_timing_and_histograms(self):
+        response = self.client.get('/0/')
+        timings = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(list(timings), ['db', 'template', 'total'])
+        queries = int(re.search(r'desc="(\d+) queries"', timings['db']).group(1))
+        self.assertGreater(queries, 0)
+
+        histograms.flush()
+        buckets = {(b.metric, b.upper_bound): b.count for b in TimingBucket.objects.filter(endpoint='polls:detail')}
+        self.assertEqual(sorted(metric for metric, _ in buckets), ['db', 'queries', 'template', 'total'])
+        self.assertEqual(set(buckets.values()), {1})
+        self.assertIn(('queries', BUCKETS[bisect.bisect_left(BUCKETS, queries)]), buckets)
+
+        self.client.get('/0/')
+        lines = [line.split() for line in report().splitlines()]
+        self.assertIn(['polls:detail', 'total'], [line[:2] for line in lines])
+        self.assertEqual([line[2] for line in lines if line[:2] == ['polls:detail', 'queries']], ['2'])
+
+    def test_percentile(self):
+        buckets = [(10, 90), (100, 9), (1000, 1)]
+        self.assertEqual([percentile(buckets, f) for f in (0.5, 0.95, 0.99, 1)], [10, 100, 100, 1000])
@@ -1,15 +1,23 @@
+from django.conf import settings
 from django.conf.urls import url
 from django.urls import path
 from django.contrib.auth import login, logout
 
+from . import async_views
 from . import views as app_views
 
+# the pages of the survey flow, in their async flavour when served through ASGI
+survey_views = async_views if getattr(settings, 'POLLS_ASYNC_VIEWS', False) else app_views
+
 app_name = 'polls'
 urlpatterns = [
-    path('', app_views.index, name='index'),
+    path('', survey_views.index, name='index'),
     path('signup/', app_views.SignUpView.as_view(), name='signup'),
-    path('<int:question_id>/', app_views.detail, name='detail'),
+    path('<int:question_id>/', survey_views.detail, name='detail'),
     path('<int:question_id>/results/', app_views.results, name='results'),
-    path('<int:question_id>/vote/', app_views.vote, name='vote'),
-    path('profile/', app_views.profile, name='profile'),
+    path('<int:question_id>/vote/', survey_views.vote, name='vote'),
+    path('answers/', app_views.submit_answers, name='submit_answers'),
+    path('profile/', survey_views.profile, name='profile'),
+    path('metrics/', app_views.metrics, name='metrics'),
+    path('export/<str:table>.csv', app_views.export, name='export'),
 ]
\ No newline at end of file
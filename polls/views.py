@@ -2,15 +2,30 @@ from django.contrib.auth import authenticate, login
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
-from django.http import Http404
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.template import loader
-from django.shortcuts import get_object_or_404, render, redirect
+from django.shortcuts import render, redirect
 from django.urls import reverse, reverse_lazy
 from django.views import generic
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.views import LoginView
-
-from .models import Question, Choice, Answer, Profile, AppConfig
-
+from django.db import transaction
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+
+from .models import ChoiceCount, Answer, AnswerVector, Profile, AppConfig
+from .catalogue import get_catalogue
+from .database import retry_if_locked
+from .export import TABLES, csv_lines
+from .fragments import match_fragment
+from .instrumentation import report
+from .jobs import enqueue_match_refresh, enqueue_match_update
+
+import functools
+import hashlib
+import json
 import logging
 
 logger = logging.getLogger('polls')
@@ -23,102 +38,60 @@ def from_email(request):
     }
 
 
-def find_answer_for_question(user, question):
-    try:
-        answer = Answer.objects.get(user=user, question=question)
-        return answer.choice
-    except Answer.DoesNotExist:
-        logger.warning("cannot find answer for user " + str(user) + " question " + str(question) + ". Return 0")
-        return 0
-
-
 def get_first_unanswered_question_index(user, questions):
     """Returns the index of the first non answered question, or
     -1 if has answered everything"""
 
-    answers = list(Answer.objects.filter(user=user))
-    min_non_answered_index = 0
-    for q in questions:
-        responded = False
-        for a in answers:
-            if a.question.id == q.id:
-                responded = True
-                break
-
-        if not responded:
-            return min_non_answered_index
-
-        min_non_answered_index += 1
-
-    return -1
-
-
-def gender_preferences_match(user1, user2):
     try:
-        profile1 = user1.profile
-        profile2 = user2.profile
-        return profile1.gender == profile2.gender_preference and profile2.gender == profile1.gender_preference
-    except:
-        return False
+        choices = user.answer_vector.choices(len(questions))
+    except AnswerVector.DoesNotExist:
+        return 0 if questions else -1
 
+    return choices.index(-1) if -1 in choices else -1
 
 
 def index(request):
     if not request.user.is_authenticated:
         return HttpResponseRedirect(reverse('login'))
 
+    context = index_context(request.user)
+    if context is None:
+        return HttpResponseRedirect(reverse('polls:profile'))
+    return render(request, 'polls/index.html', context)
+
+
+def index_context(user):
+    """Returns the context of the index page of user, or None if it must fill its profile first"""
+
     # if user has no profile, AND we require gender, redirect to the profile to create one
     pedir_genero = AppConfig.get().pedir_genero
     if pedir_genero:
         try:
-            request.user.profile
+            user.profile
         except:
-            return HttpResponseRedirect(reverse('polls:profile'))
+            return None
 
-
-    questions = list(Question.objects.all())
-    unanswered = get_first_unanswered_question_index(request.user, questions)
-    matches = []
-    users = list(User.objects.all())
+    catalogue = get_catalogue()
+    questions = catalogue.questions
+    unanswered = get_first_unanswered_question_index(user, questions)
     has_completed_poll = unanswered == -1
-    results = []
-
-    if has_completed_poll:
-        # compare with every user that finished the poll
-        for u in users:
-            if u == request.user:
-                continue  # skip, will always match 100% myself
-
-            if get_first_unanswered_question_index(u, questions) != -1:
-                continue  # skip users that have not answered everything.
-
-            # if gender filter is on, require to be the gender we're asking
-            if pedir_genero and (not gender_preferences_match(u, request.user)):
-                continue
-
-            score = 0.0
-            max_score = len(questions)
-            for q in questions:
-                my_answer = find_answer_for_question(request.user, q)
-                u_answer = find_answer_for_question(u, q)
-                if my_answer == u_answer:
-                    score += 1.0
+    matches_html = ''
+    calculating = False
 
-            score = int(score / max_score * 100.0)  # convert score to percent
-            results.append({'user': u, 'score': score})
+    if has_completed_poll and questions:
+        # serve the last computed matches, a worker refreshes them if outdated
+        vector = user.answer_vector
+        if vector.matches_stale:
+            enqueue_match_refresh(user)
+        matches_html, shown = match_fragment(user, vector, catalogue, AppConfig.get())
+        calculating = vector.matches_stale and not shown
 
-    def take_score(entry):
-        return entry['score']
-
-    results.sort(key=take_score, reverse=True)
-    results = results[0:AppConfig.get().afinidad_cantidad_gente]
-
-    context = {
+    return {
         'latest_question_index': unanswered,
         'has_completed_poll': has_completed_poll,
-        'matches': results
+        'calculating': calculating,
+        'matches_html': matches_html
     }
-    return render(request, 'polls/index.html', context)
 
 
 class SignupFormWithEmail(UserCreationForm):
@@ -144,24 +117,91 @@ def get_sign_up_form():
 
 
 class SignUpView(generic.CreateView):
-    form_class = get_sign_up_form()
     success_url = reverse_lazy('login')
     template_name = 'registration/signup.html'
 
+    def get_form_class(self):
+        # picked on every request, the config can change while the site runs
+        return get_sign_up_form()
+
 
 def detail(request, question_id):
     if not request.user.is_authenticated:
         return HttpResponseRedirect(reverse('login'))
 
-
-    questions = list(Question.objects.all())
+    etag, choice = detail_validators(request, question_id)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, 'polls/detail.html', detail_context(request.user, question_id, choice))
+    return set_validators(response, etag)
+
+
+# templates of the question page, part of its ETag
+DETAIL_TEMPLATES = ('polls/detail.html', 'polls/base.html')
+
+
+@functools.lru_cache(maxsize=None)
+def deploy_version():
+    """Token of the running release, so pages rendered by an older one are never
+    validated: POLLS_DEPLOY_VERSION if set, otherwise a hash of the question page
+    templates and of the static files manifest, the same in every process"""
+    version = getattr(settings, 'POLLS_DEPLOY_VERSION', None)
+    if version:
+        return str(version)
+    h = hashlib.sha1()
+    for name in DETAIL_TEMPLATES:
+        with open(loader.get_template(name).origin.name, 'rb') as f:
+            h.update(f.read())
+    read_manifest = getattr(staticfiles_storage, 'read_manifest', None)
+    h.update(((read_manifest() if read_manifest else None) or '').encode())
+    return h.hexdigest()[:12]
+
+
+def detail_validators(request, question_id):
+    """Returns the ETag of the page of the question at position question_id for
+    request.user and the choice the user picked there, or None, for detail_context().
+    The ETag is None if there is no such question. The page only changes with the
+    release, the catalogue, the config, the answer of the user to the question and
+    the CSRF cookie its form holds the token of. The ETag is weak, the masked CSRF
+    token differs on every render. There is no Last-Modified: only the answer has a
+    modification time, so If-Modified-Since alone would miss the rest."""
+    catalogue = get_catalogue()
+    if question_id < 0 or question_id >= len(catalogue):
+        return None, None
+
+    answer = Answer.objects.filter(user=request.user, question=catalogue[question_id]) \
+        .values_list('choice', 'updated_at').first()
+    choice, updated_at = answer or (None, None)
+    cfg = AppConfig.get()
+    config = [getattr(cfg, f.attname) for f in cfg._meta.concrete_fields] if cfg else None
+    key = repr((deploy_version(), catalogue.version, question_id, request.user.pk, choice, updated_at, config,
+                request.META.get('CSRF_COOKIE')))
+    return 'W/' + quote_etag(hashlib.sha1(key.encode()).hexdigest()[:20]), choice
+
+
+def set_validators(response, etag):
+    """Adds the detail_validators() ETag to response. Browsers must check it on
+    every visit, since the page changes as soon as the user votes."""
+    if etag:
+        response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+_UNKNOWN = object()
+
+
+def detail_context(user, question_id, choice=_UNKNOWN):
+    """Returns the context of the page of the question at position question_id. choice
+    is the one user picked there, or None, if already read by detail_validators()."""
+    questions = get_catalogue()
     if question_id < 0 or question_id >= len(questions):
         raise Http404("invalid question index: " + str(question_id))
 
     question = questions[question_id]
 
     col_size = 4  # bootstrap column size depending on choice count
-    choices = question.choice_set.all()
+    choices = question.choices
     choice_count = len(choices)
     if choice_count == 2:
         col_size = 6
@@ -176,6 +216,7 @@ def detail(request, question_id):
 
     context = {
         'question': question,
+        'choices': choices,
         'has_answer': False,
         'answer_index': 0,
         'question_index': question_id,
@@ -185,32 +226,46 @@ def detail(request, question_id):
         'is_first': question_id == 0,
         'prev_question_id': question_id - 1,
         'col_size': col_size,
+        'image_sizes': '(min-width: 768px) %dvw, 100vw' % (col_size * 100 // 12),
         'is_image': is_image
     }
 
-    try:
-        answer = Answer.objects.get(user=request.user, question=question)
+    if choice is _UNKNOWN:
+        choice = Answer.objects.filter(user=user, question=question).values_list('choice', flat=True).first()
+    if choice is not None:
         context['has_answer'] = True
-        context['answer_index'] = answer.choice
-        logger.info("found answer for such question: " + str(answer.choice))
-    except Answer.DoesNotExist:
+        context['answer_index'] = choice
+        logger.info("found answer for such question: " + str(choice))
+    else:
         logger.info("can't find answer")
 
-    return render(request, 'polls/detail.html', context)
+    return context
 
 
 def results(request, question_id):
-    question = get_object_or_404(Question, pk=question_id)
-    return render(request, 'polls/results.html', {'question': question})
-
-
-def vote(request, question_id):
-    questions = list(Question.objects.all())
+    """Votes of every choice of the question at position question_id, read from the ChoiceCount counters"""
+    questions = get_catalogue()
     if question_id < 0 or question_id >= len(questions):
-        return Http404("invalid question index: " + question_id)
+        raise Http404("invalid question index: " + str(question_id))
 
     question = questions[question_id]
+    votes = dict(ChoiceCount.objects.filter(question_id=question.id).values_list('choice', 'votes'))
+    total = sum(votes.get(i, 0) for i in range(len(question.choices)))
+    choices = [{
+        'choice': choice,
+        'votes': votes.get(i, 0),
+        'percent': int(votes.get(i, 0) / total * 100.0) if total else 0,
+    } for i, choice in enumerate(question.choices)]
+
+    return render(request, 'polls/results.html', {
+        'question': question,
+        'question_index': question_id,
+        'choices': choices,
+        'total': total,
+    })
 
+
+def vote(request, question_id):
     if not request.user.is_authenticated:
         return HttpResponseRedirect(reverse('login'))
 
@@ -218,29 +273,125 @@ def vote(request, question_id):
         selected_choice = request.POST['choice']
     except KeyError:
         # Redisplay the question voting form.
-        # TODO display with all the metadata
-        return render(request, 'polls/detail.html', {
-            'question': question,
-            'error_message': "No elegiste ninguna opción.",
-        })
+        return render(request, 'polls/detail.html', missing_choice_context(request.user, question_id))
     else:
-        # Get or create an answer for such question
-        try:
-            answer = Answer.objects.get(user=request.user, question=question)
-        except Answer.DoesNotExist:
-            answer = Answer.objects.create(user=request.user, question=question)
+        choice = parse_choice(question_id, selected_choice)
+        if choice is None:
+            return HttpResponseBadRequest("invalid choice", content_type="text/plain")
 
-        answer.choice = selected_choice
-        answer.save()
+        return HttpResponseRedirect(save_vote(request.user, question_id, choice))
 
-        logger.info("Selected choice: user " + request.user.username +
-                    " question " + question.question_text +
-                    " choice: " + selected_choice)
 
-        if question_id + 1 < len(questions):  # redirect to next question
-            return HttpResponseRedirect(reverse('polls:detail', args=(question_id + 1,)))
-        else:  # no more questions, redirect to home
-            return HttpResponseRedirect(reverse('polls:index'))
+def parse_choice(question_id, value):
+    """Returns the choice index posted for the question at position question_id, or
+    None if it isn't the index of one of its choices"""
+    questions = get_catalogue()
+    if question_id < 0 or question_id >= len(questions):
+        raise Http404("invalid question index: " + str(question_id))
+
+    try:
+        choice = int(value)
+    except ValueError:
+        return None
+    return choice if 0 <= choice < len(questions[question_id].choices) else None
+
+
+def missing_choice_context(user, question_id):
+    context = detail_context(user, question_id)
+    context['error_message'] = "No elegiste ninguna opción."
+    return context
+
+
+@retry_if_locked
+def save_vote(user, question_id, choice):
+    """Saves the choice picked by user for the question at position question_id.
+    Returns the url of the page to show next."""
+    questions = get_catalogue()
+    if question_id < 0 or question_id >= len(questions):
+        raise Http404("invalid question index: " + str(question_id))
+
+    question = questions[question_id]
+
+    # create or update the answer for such question in a single statement
+    Answer.upsert(user, {question.id: choice})
+
+    vector, _ = AnswerVector.objects.get_or_create(user=user)
+    vector.set_choice(question_id, choice, len(questions))
+    vector.save(update_fields=['answers', 'completed'])  # the match list state belongs to the workers
+    if vector.completed:
+        enqueue_match_update(user)
+
+    logger.info("Selected choice: user " + user.username +
+                " question " + question.question_text +
+                " choice: " + str(choice))
+
+    if question_id + 1 < len(questions):  # redirect to next question
+        return reverse('polls:detail', args=(question_id + 1,))
+    else:  # no more questions, redirect to home
+        return reverse('polls:index')
+
+
+@require_POST
+def submit_answers(request):
+    """Saves the answers to many questions at once, so the whole poll can be sent
+    in one request. Expects a JSON body like {"choices": [0, 2, null, 1]} holding
+    the choice index picked for every question position, or null to skip it."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': "login required"}, status=401)
+
+    try:
+        choices = json.loads(request.body)['choices']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': "expected a JSON body with a 'choices' list"}, status=400)
+
+    questions = get_catalogue()
+    if not isinstance(choices, list) or len(choices) > len(questions):
+        return JsonResponse({'error': "'choices' must be a list of at most %d items" % len(questions)}, status=400)
+
+    picked = {}
+    for position, choice in enumerate(choices):
+        if choice is None:
+            continue
+        if type(choice) is not int or not 0 <= choice < len(questions[position].choices):
+            return JsonResponse({'error': "invalid choice for question " + str(position)}, status=400)
+        picked[position] = choice
+
+    with transaction.atomic():
+        Answer.upsert(request.user, {questions[p].id: c for p, c in picked.items()})
+
+        vector, _ = AnswerVector.objects.get_or_create(user=request.user)
+        merged = vector.choices(len(questions))
+        for position, choice in picked.items():
+            merged[position] = choice
+        vector.set_choices(merged)
+        vector.save(update_fields=['answers', 'completed'])
+
+    if vector.completed:
+        enqueue_match_update(request.user)
+
+    logger.info("Saved " + str(len(picked)) + " answers for user " + request.user.username)
+    return JsonResponse({
+        'saved': len(picked),
+        'has_completed_poll': vector.completed,
+        'first_unanswered': merged.index(-1) if -1 in merged else -1,
+    })
+
+
+@staff_member_required
+def metrics(request):
+    """Per endpoint timing histograms collected by the instrumentation middleware"""
+    return HttpResponse(report(), content_type='text/plain; charset=utf-8')
+
+
+@staff_member_required
+def export(request, table):
+    """Streams the answers or the match lists as CSV, see `manage.py exportpolls`"""
+    if table not in TABLES:
+        raise Http404("unknown table: " + table)
+
+    response = StreamingHttpResponse(csv_lines(table), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % table
+    return response
 
 
 def profile(request):
@@ -248,34 +399,40 @@ def profile(request):
         return HttpResponseRedirect(reverse('login'))
 
     if request.method == "GET":
-        context = {
-            'gender': 'M',
-            'gender_preference': 'F'
-        }
-        try:
-            p = request.user.profile
-            context['gender'] = p.gender
-            context['gender_preference'] = p.gender_preference
-        except:  # ignore, set to defaults
-            pass
-
-        logger.info("context is " + str(context))
-        return render(request, 'polls/profile.html', context)
+        return render(request, 'polls/profile.html', profile_context(request.user))
     elif request.method == "POST":
+        save_profile(request.user, request.POST['gender'], request.POST['gender_preference'])
+        return HttpResponseRedirect(reverse('polls:index'))
 
-        # make the profile for this user
-        try:
-            profile = Profile.objects.get(user=request.user)
 
-        except Profile.DoesNotExist:
-            profile = Profile.objects.create(user=request.user)
+def profile_context(user):
+    context = {
+        'gender': 'M',
+        'gender_preference': 'F'
+    }
+    try:
+        p = user.profile
+        context['gender'] = p.gender
+        context['gender_preference'] = p.gender_preference
+    except:  # ignore, set to defaults
+        pass
+
+    logger.info("context is " + str(context))
+    return context
 
 
-        profile.gender = request.POST['gender']
-        profile.gender_preference = request.POST['gender_preference']
-        profile.save()
+@retry_if_locked
+def save_profile(user, gender, gender_preference):
+    # make the profile for this user
+    try:
+        profile = Profile.objects.get(user=user)
 
-        logger.warning("g")
+    except Profile.DoesNotExist:
+        profile = Profile.objects.create(user=user)
 
-        return HttpResponseRedirect(reverse('polls:index'))
+    profile.gender = gender
+    profile.gender_preference = gender_preference
+    profile.save()
 
+    # gender changes who is a candidate for who
+    enqueue_match_update(user)